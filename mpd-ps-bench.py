@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+
+# Benchmark for mpd-ps. Generates a synthetic music library, serves it as
+# playlist of a stand-in MPD server and times mpd-ps on the following
+# scenarios:
+#   cold     sync into an empty destination folder
+#   warm     sync again without changes
+#   changed  sync again after 1% of the source files were modified
+#   prune    sync after half of the playlist was removed
+# Results are written as JSON, so they can be compared across versions.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+__author__ = 'Clemens Hoffmann [clemens [at] vibee.de]'
+
+SCENARIOS = ("cold", "warm", "changed", "prune")
+
+# Stand-in for ffmpeg, which copies the source to the output file. The
+# "transcoded" file has the same length as its source, so mpd-ps considers it
+# complete on later runs.
+ENCODER = """#!{python}
+import shutil
+import sys
+shutil.copyfile(sys.argv[sys.argv.index("-i") + 1], sys.argv[-1])
+"""
+
+
+# Writers of small audio files with valid headers, as far as mpd-ps and
+# mutagen look at them. The audio data itself is silence or zeros.
+class AudioFiles:
+    SAMPLE_RATE = 44100
+
+    # fLaC marker and STREAMINFO block
+    @classmethod
+    def flac(cls, seconds, size):
+        samples = cls.SAMPLE_RATE * seconds
+        info = struct.pack(">HH", 4096, 4096) + bytes(6)
+        # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample
+        # - 1, 36 bits total samples
+        info += ((cls.SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) |
+                 samples).to_bytes(8, "big")
+        info += bytes(16)
+        return b"fLaC" + bytes([0x80, 0, 0, len(info)]) + info + \
+            bytes(max(size - len(info) - 8, 0))
+
+    # MPEG-1 layer 3 frames with 44.1kHz
+    @classmethod
+    def mp3(cls, seconds, bitrate):
+        bitrates = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224,
+                    256, 320)
+        header = bytes([0xff, 0xfb, bitrates.index(bitrate) << 4, 0x00])
+        frame_size = 144 * bitrate * 1000 // cls.SAMPLE_RATE
+        frames = seconds * cls.SAMPLE_RATE // 1152
+        return (header + bytes(frame_size - len(header))) * frames
+
+    @staticmethod
+    def atom(name, *children):
+        data = b"".join(children)
+        return struct.pack(">I", len(data) + 8) + name + data
+
+    # MP4 container with a single AAC track
+    @classmethod
+    def m4a(cls, seconds, bitrate):
+        atom = cls.atom
+        duration = seconds * cls.SAMPLE_RATE
+        mdhd = atom(b"mdhd", bytes(12), struct.pack(
+            ">II", cls.SAMPLE_RATE, duration), bytes(4))
+        hdlr = atom(b"hdlr", bytes(8), b"soun", bytes(13))
+        # Elementary stream descriptor: AAC LC, average bitrate
+        config = bytes([0x05, 0x02, 0x12, 0x10])
+        decoder = bytes([0x04, 13 + len(config), 0x40, 0x15]) + bytes(3) + \
+            struct.pack(">II", bitrate * 1000, bitrate * 1000) + config
+        es = bytes([0x03, 3 + len(decoder) + 3]) + bytes(3) + decoder + \
+            bytes([0x06, 0x01, 0x02])
+        esds = atom(b"esds", bytes(4), es)
+        mp4a = atom(b"mp4a", bytes(6), struct.pack(">H", 1), bytes(8),
+                    struct.pack(">HHHHI", 2, 16, 0, 0,
+                                cls.SAMPLE_RATE << 16), esds)
+        stsd = atom(b"stsd", bytes(4), struct.pack(">I", 1), mp4a)
+        mvhd = atom(b"mvhd", bytes(12), struct.pack(
+            ">II", cls.SAMPLE_RATE, duration), bytes(80))
+        moov = atom(b"moov", mvhd, atom(b"trak", atom(
+            b"mdia", mdhd, hdlr, atom(b"minf", atom(b"stbl", stsd)))))
+        mdat = atom(b"mdat", bytes(bitrate * 1000 // 8 * seconds))
+        return atom(b"ftyp", b"M4A ", bytes(4), b"M4A mp42isom") + moov + \
+            mdat
+
+
+# Synthetic library of artists, albums and tracks. A third of the albums are
+# FLAC, the others MP3 or M4A with high (transcoded) or low (copied)
+# bitrates. Every album has a cover.
+class Library:
+    TRACKS = 10
+
+    def __init__(self, root, files, seconds, seed):
+        self.root = root
+        self.files = files
+        self.seconds = seconds
+        self.random = random.Random(seed)
+        self.songs = []
+
+    def generate(self):
+        kinds = ("flac", "mp3", "m4a")
+        album = 0
+        while len(self.songs) < self.files:
+            kind = kinds[album % len(kinds)]
+            high = album % 2 == 0
+            folder = os.path.join("Artist %03d" % (album // 5),
+                                  "Album %04d" % album)
+            os.makedirs(os.path.join(self.root, folder))
+            with open(os.path.join(self.root, folder, "cover.jpg"),
+                      "wb") as file:
+                file.write(b"\xff\xd8\xff\xe0" + self.random.getrandbits(
+                    20000 * 8).to_bytes(20000, "big") + b"\xff\xd9")
+            for track in range(min(self.TRACKS,
+                                   self.files - len(self.songs))):
+                name = os.path.join(folder, "%02d Track.%s" % (track + 1,
+                                                                kind))
+                with open(os.path.join(self.root, name), "wb") as file:
+                    file.write(self.create(kind, high))
+                self.songs.append(name)
+            album += 1
+        return self.songs
+
+    def create(self, kind, high):
+        if kind == "flac":
+            return AudioFiles.flac(self.seconds, 20000 * self.seconds)
+        if kind == "mp3":
+            return AudioFiles.mp3(self.seconds, 320 if high else 128)
+        return AudioFiles.m4a(self.seconds, 256 if high else 96)
+
+    # Modify some songs, so they have to be synced again
+    def change(self, fraction):
+        changed = self.random.sample(self.songs, max(
+            1, int(len(self.songs) * fraction)))
+        for name in changed:
+            with open(os.path.join(self.root, name), "r+b") as file:
+                file.seek(-1, os.SEEK_END)
+                file.write(b"\x01")
+        return changed
+
+
+# Stand-in for MPD, answering the commands mpd-ps sends with the songs of
+# its playlist.
+class FakeMpdServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root, seconds):
+        super().__init__(("127.0.0.1", 0), FakeMpdHandler)
+        self.root = root
+        self.seconds = seconds
+        self.playlist = []
+        self.version = 1
+        self.lock = threading.Lock()
+
+    def set_playlist(self, songs):
+        with self.lock:
+            self.playlist = list(songs)
+            self.version += 1
+
+    def song_info(self, position, name):
+        info = ["file: " + name]
+        try:
+            info.append("Last-Modified: " + time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(
+                    os.stat(os.path.join(self.root, name)).st_mtime)))
+        except OSError:
+            pass
+        return info + ["Time: " + str(self.seconds),
+                       "duration: " + str(self.seconds) + ".000",
+                       "Pos: " + str(position), "Id: " + str(position + 1)]
+
+    def run(self, line):
+        command, _, argument = line.partition(" ")
+        argument = argument.strip('"')
+        with self.lock:
+            playlist = self.playlist
+            version = self.version
+        if command == "status":
+            return ["playlist: " + str(version),
+                    "playlistlength: " + str(len(playlist)), "state: stop"]
+        if command == "playlist":
+            return [str(position) + ":file: " + name
+                    for position, name in enumerate(playlist)]
+        if command == "playlistinfo":
+            start, end = 0, len(playlist)
+            if ":" in argument:
+                start, end = argument.split(":")
+                start, end = int(start), int(end or len(playlist))
+            elif argument:
+                start = int(argument)
+                end = start + 1
+            return [line for position in range(start, min(end,
+                                                          len(playlist)))
+                    for line in self.song_info(position, playlist[position])]
+        if command in ("password", "ping"):
+            return []
+        raise ValueError(command)
+
+
+class FakeMpdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"OK MPD 0.23.5\n")
+        command_list = None
+        for line in self.rfile:
+            line = line.decode().strip()
+            if line in ("command_list_begin", "command_list_ok_begin"):
+                command_list = (line, [])
+            elif line == "command_list_end":
+                kind, commands = command_list
+                command_list = None
+                output = []
+                for command in commands:
+                    output += self.server.run(command)
+                    if kind == "command_list_ok_begin":
+                        output.append("list_OK")
+                self.send(output)
+            elif command_list is not None:
+                command_list[1].append(line)
+            elif line == "close":
+                return
+            else:
+                try:
+                    self.send(self.server.run(line))
+                except ValueError:
+                    self.wfile.write(("ACK [5@0] {} unknown command \"" +
+                                      line + "\"\n").encode())
+
+    def send(self, lines):
+        self.wfile.write(("".join(line + "\n" for line in lines) +
+                          "OK\n").encode())
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.script = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "mpd-ps.py")
+
+    def write_config(self, work_dir, port):
+        general = {"src": os.path.join(work_dir, "music"),
+                   "dest": os.path.join(work_dir, "dest"),
+                   "ffmpeg": self.ffmpeg,
+                   "delete_non_existent": "True",
+                   "transcode_mp3": "True",
+                   "transcode_m4a": "True"}
+        # Options given on the command line override the defaults above
+        for option in self.args.option:
+            key, _, value = option.partition("=")
+            general[key.strip()] = value.strip()
+        config = os.path.join(work_dir, "mpd-ps.conf")
+        with open(config, "w") as file:
+            file.write("[General]\n")
+            for key, value in general.items():
+                file.write(key + "=" + value + "\n")
+            file.write("[Host]\nhost=127.0.0.1\nport=" + str(port) + "\n")
+        return config
+
+    def run_sync(self, config):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, self.script, "--config",
+                                  config], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        seconds = time.perf_counter() - start
+        if process.returncode:
+            sys.stderr.write("\n".join(
+                process.stderr.splitlines()[-10:]) + "\n")
+        return {"seconds": round(seconds, 3),
+                "returncode": process.returncode}
+
+    # Run all scenarios once on a fresh library and destination
+    def run_once(self, work_dir, server, songs, library):
+        config = self.write_config(work_dir, server.server_address[1])
+        shutil.rmtree(os.path.join(work_dir, "dest"), ignore_errors=True)
+        server.set_playlist(songs)
+        results = {}
+        results["cold"] = self.run_sync(config)
+        results["warm"] = self.run_sync(config)
+        library.change(self.args.changed)
+        results["changed"] = self.run_sync(config)
+        server.set_playlist(songs[::2])
+        results["prune"] = self.run_sync(config)
+        return results
+
+    def run(self):
+        work_dir = self.args.work_dir or tempfile.mkdtemp(
+            prefix="mpd-ps-bench.")
+        os.makedirs(work_dir, exist_ok=True)
+        music_dir = os.path.join(work_dir, "music")
+        shutil.rmtree(music_dir, ignore_errors=True)
+        self.ffmpeg = self.args.ffmpeg
+        if not self.ffmpeg:
+            self.ffmpeg = os.path.join(work_dir, "encoder.py")
+            with open(self.ffmpeg, "w") as file:
+                file.write(ENCODER.format(python=sys.executable))
+            os.chmod(self.ffmpeg, 0o755)
+
+        start = time.perf_counter()
+        library = Library(music_dir, self.args.files, self.args.seconds,
+                          self.args.seed)
+        songs = library.generate()
+        generate_time = time.perf_counter() - start
+
+        server = FakeMpdServer(music_dir, self.args.seconds)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        runs = []
+        try:
+            for repeat in range(self.args.repeat):
+                # Restore the playlist and the modified files
+                if repeat:
+                    shutil.rmtree(music_dir)
+                    library = Library(music_dir, self.args.files,
+                                      self.args.seconds, self.args.seed)
+                    songs = library.generate()
+                runs.append(self.run_once(work_dir, server, songs, library))
+        finally:
+            server.shutdown()
+            server.server_close()
+            if not self.args.work_dir and not self.args.keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        scenarios = {}
+        for scenario in SCENARIOS:
+            times = [run[scenario]["seconds"] for run in runs]
+            scenarios[scenario] = {
+                "seconds": round(statistics.median(times), 3),
+                "min": min(times),
+                "max": max(times),
+                "runs": times,
+                "failed": sum(1 for run in runs
+                              if run[scenario]["returncode"])}
+        return {"label": self.args.label,
+                "version": self.get_version(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "files": len(songs),
+                "seconds_per_file": self.args.seconds,
+                "changed_fraction": self.args.changed,
+                "encoder": self.args.ffmpeg or "copy",
+                "options": self.args.option,
+                "generate_seconds": round(generate_time, 3),
+                "scenarios": scenarios}
+
+    # Commit of the benchmarked mpd-ps, if it is run from a git checkout
+    def get_version(self):
+        try:
+            return subprocess.run(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=os.path.dirname(self.script), stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, universal_newlines=True,
+                check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark mpd-ps on a "
+                                                 "synthetic music library.")
+    parser.add_argument("--files", help="number of songs in the library.",
+                        type=int, default=2000)
+    parser.add_argument("--seconds", help="length of each song.", type=int,
+                        default=2)
+    parser.add_argument("--changed", help="fraction of songs modified for "
+                                          "the changed scenario.",
+                        type=float, default=0.01)
+    parser.add_argument("--repeat", help="number of runs of all scenarios.",
+                        type=int, default=1)
+    parser.add_argument("--seed", help="seed for the generated library.",
+                        type=int, default=0)
+    parser.add_argument("--ffmpeg", help="encoder to use instead of copying "
+                                         "the files to be transcoded.")
+    parser.add_argument("--option", help="additional option for the "
+                                         "[General] section of the config, "
+                                         "e.g. threads=4.",
+                        action="append", default=[])
+    parser.add_argument("--work-dir", help="folder for library and "
+                                           "destination, kept after the "
+                                           "run.", dest="work_dir")
+    parser.add_argument("--keep", help="keep the temporary work folder.",
+                        action="store_true")
+    parser.add_argument("--label", help="name of this run in the results.")
+    parser.add_argument("--output", help="write the results to this file "
+                                         "instead of stdout.")
+    args = parser.parse_args()
+    results = Benchmark(args).run()
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if any(scenario["failed"] for scenario in results["scenarios"].values()):
+        exit(1)
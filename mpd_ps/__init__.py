@@ -0,0 +1,10 @@
+# mpd-ps syncs the MPD playlist to a folder, e.g. on a phone or SD card,
+# transcoding lossless files on the way. See SyncEngine for using it from
+# other programs; the command line interface is mpd_ps.cli.
+
+from mpd_ps.core import ConfigError, MpdPs, SyncAction, SyncCancelled, \
+    SyncPlan, TargetPlan
+from mpd_ps.engine import SyncEngine
+
+__all__ = ["ConfigError", "MpdPs", "SyncAction", "SyncCancelled",
+           "SyncEngine", "SyncPlan", "TargetPlan"]
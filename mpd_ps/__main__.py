@@ -0,0 +1,5 @@
+import sys
+
+from mpd_ps.cli import main
+
+sys.exit(main())
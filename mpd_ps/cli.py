@@ -0,0 +1,93 @@
+import argparse
+import logging
+import signal
+import sys
+
+from mpd_ps.core import ConfigError, MpdPs
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="mpd-ps")
+    parser.add_argument("--config", help="specify path to config "
+                                         "file.", dest="config")
+    parser.add_argument("--rebuild-manifest", help="ignore the manifest of "
+                                                   "the last sync and probe "
+                                                   "all files again.",
+                        dest="rebuild_manifest", action="store_true")
+    parser.add_argument("--check-manifest", help="verify the manifest "
+                                                 "against the destination "
+                                                 "folder before syncing.",
+                        dest="check_manifest", action="store_true")
+    parser.add_argument("--dry-run", help="only report which files would "
+                                          "be copied and transcoded.",
+                        dest="dry_run", action="store_true")
+    parser.add_argument("--prune-dry-run", help="only report which files "
+                                                "would be removed from the "
+                                                "destination folder.",
+                        dest="prune_dry_run", action="store_true")
+    parser.add_argument("--watch", help="keep running and sync changes of "
+                                        "the playlist as they happen.",
+                        dest="watch", action="store_true")
+    parser.add_argument("--progress", help="show a progress bar while "
+                                           "syncing.",
+                        dest="progress", action="store_true")
+    parser.add_argument("--events", help="write progress and timing "
+                                         "events as JSON lines to this file "
+                                         "(- for stdout).",
+                        dest="events")
+    parser.add_argument("--plan", help="with --dry-run, list the transcoding "
+                                       "jobs and predict how long they "
+                                       "take.",
+                        dest="show_plan", action="store_true")
+    return parser.parse_args(argv)
+
+
+# Run mpd-ps from the command line. Returns the exit status.
+def main(argv=None):
+    args = parse_args(argv)
+    mpd_ps = MpdPs(args.config)
+    mpd_ps.rebuild_manifest = args.rebuild_manifest
+    mpd_ps.check_manifest = args.check_manifest
+    mpd_ps.dry_run = args.dry_run
+    mpd_ps.prune_dry_run = args.prune_dry_run
+    mpd_ps.show_plan = args.show_plan
+    try:
+        mpd_ps.read_config()
+        if mpd_ps.verbose:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            logging.basicConfig(level=logging.INFO)
+        mpd_ps.check_config()
+    except ConfigError as e:
+        logging.getLogger("mpd-ps").error(str(e))
+        return -1
+    mpd_ps.metrics.progress = args.progress and sys.stderr.isatty()
+    if args.events == "-":
+        mpd_ps.metrics.events = sys.stdout
+    elif args.events:
+        mpd_ps.metrics.events = open(args.events, "a")
+    for target in mpd_ps.targets:
+        if target.use_manifest:
+            target.open_manifest()
+    try:
+        if args.watch:
+            # Stop watching cleanly when terminated as a service
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            mpd_ps.watch()
+            success = True
+        else:
+            mpd_ps.get_mpd_playlist()
+            success = mpd_ps.sync()
+    except KeyboardInterrupt:
+        # ffmpeg runs in a session of its own and doesn't get SIGINT
+        mpd_ps.cancel()
+        success = False
+    finally:
+        for target in mpd_ps.targets:
+            if target.manifest:
+                target.manifest.close()
+        if mpd_ps.transcode_cache:
+            mpd_ps.transcode_cache.close()
+        if mpd_ps.metrics.events and mpd_ps.metrics.events is not sys.stdout:
+            mpd_ps.metrics.events.close()
+    return 0 if success else 1
@@ -0,0 +1,2920 @@
+import calendar
+import collections
+import concurrent.futures
+import configparser
+import copy
+import errno
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import re
+import shlex
+import shutil
+import signal
+import sqlite3
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+
+# mpd, mutagen, xxhash and Pillow are imported where they are needed, so
+# importing mpd-ps stays fast and optional modules are only required when
+# used.
+
+__author__ = 'Clemens Hoffmann [clemens [at] vibee.de]'
+
+FINGERPRINTS = ("blake2", "xxhash")
+ALBUM_ART_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+# Bytes read at once when probing audio headers
+PROBE_SIZE = 64 * 1024
+# ioctl cloning a file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+AudioInfo = namedtuple("AudioInfo", ["bitrate", "length", "codec"])
+
+
+# Raised for invalid or missing options.
+class ConfigError(Exception):
+    pass
+
+
+# Raised by SyncEngine.run when a sync was cancelled.
+class SyncCancelled(Exception):
+    pass
+
+
+# Content hash of a source file, prefixed by the algorithm used.
+def get_fingerprint(path, algorithm):
+    if algorithm == "xxhash":
+        import xxhash
+        digest = xxhash.xxh64()
+    else:
+        digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return algorithm + ":" + digest.hexdigest()
+
+
+# Hard link src to dest. If the file system doesn't support this, or src is
+# on another file system, dest becomes a reflink (copy on write clone) of src
+# where possible, or a copy made by copy. Returns False if src doesn't
+# exist.
+def link_file(src, dest, copy=shutil.copyfile):
+    # A dest left by an interrupted sync may be a hard link to src. Opening
+    # it for writing would truncate src, so it is replaced instead.
+    try:
+        os.remove(dest)
+    except FileNotFoundError:
+        pass
+    # link also fails with ENOENT while src is being replaced, so a missing
+    # src is only detected when opening it
+    try:
+        os.link(src, dest)
+        return True
+    except OSError:
+        pass
+    try:
+        if not reflink_file(src, dest):
+            copy(src, dest)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def reflink_file(src, dest):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dest)
+    return False
+
+
+# Create a new empty file with a unique name in folder. Unlike with mkstemp
+# alone, it gets the permissions of a normally created file, as it may end
+# up in the destination.
+def create_temp_file(folder, prefix, suffix):
+    fd, path = tempfile.mkstemp(suffix, prefix, folder)
+    os.close(fd)
+    os.chmod(path, 0o666 & ~get_umask())
+    return path
+
+
+# The umask of the process. It can only be read by setting it, which affects
+# files created by other threads meanwhile, so this is done once, before any
+# worker threads run.
+@functools.lru_cache(maxsize=None)
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Whether the optional module name is installed, without importing it.
+def has_module(name):
+    import importlib.util
+    return importlib.util.find_spec(name) is not None
+
+
+# Allocate size bytes for the file fd on Linux, so it isn't fragmented by
+# files written at the same time. Unlike posix_fallocate, which writes zeros
+# to file systems not supporting this, it fails there.
+def preallocate_file(fd, size):
+    fallocate = get_fallocate()
+    return fallocate is not None and fallocate(fd, 0, 0, size) == 0
+
+
+@functools.lru_cache(maxsize=None)
+def get_fallocate():
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (ImportError, OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                          ctypes.c_int64]
+    return fallocate
+
+
+# Writes files to the destination. Copies use copy_file_range or sendfile
+# where available, and a buffer sized for the destination file system
+# otherwise. Files are preallocated and get the permission bits of their
+# source, unless the file system doesn't support this (e.g. FAT). At most
+# write_threads files are written at once, and written files are flushed to
+# the device in batches of fsync_batch bytes.
+class DestinationWriter:
+    MIN_BUFFER_SIZE = 128 * 1024
+    MAX_BUFFER_SIZE = 8 * 1024 * 1024
+    # Maximum bytes per copy_file_range or sendfile call
+    CHUNK_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, dest_dir, write_threads=0, buffer_size=0,
+                 preallocate=True, fsync_batch=0):
+        self.slots = threading.BoundedSemaphore(write_threads) \
+            if write_threads > 0 else None
+        self.preallocate = preallocate and sys.platform.startswith("linux")
+        self.copy_mode = True
+        self.copy_file_range = hasattr(os, "copy_file_range")
+        self.sendfile = hasattr(os, "sendfile") and \
+            sys.platform.startswith("linux")
+        self.fsync_batch = fsync_batch
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_size = 0
+        self.block_size = 4096
+        try:
+            self.block_size = os.stat(dest_dir).st_blksize or 4096
+        except (OSError, AttributeError):
+            pass
+        # Large clusters (e.g. exFAT on SD cards) get large writes
+        self.buffer_size = buffer_size or min(max(
+            self.block_size * 64, self.MIN_BUFFER_SIZE), self.MAX_BUFFER_SIZE)
+
+    def acquire(self):
+        if self.slots:
+            self.slots.acquire()
+
+    def release(self):
+        if self.slots:
+            self.slots.release()
+
+    # Copy the content of src to dest.
+    def copy(self, src, dest):
+        self.acquire()
+        try:
+            with open(src, "rb", buffering=0) as src_file, \
+                    open(dest, "wb", buffering=0) as dest_file:
+                src_stat = os.fstat(src_file.fileno())
+                preallocated = self.allocate(dest_file.fileno(),
+                                             src_stat.st_size)
+                size = self.copy_data(src_file, dest_file, src_stat.st_size)
+                # The source may have shrunk meanwhile
+                if preallocated and size != src_stat.st_size:
+                    os.ftruncate(dest_file.fileno(), size)
+                self.copy_permissions(dest_file.fileno(), src_stat)
+        finally:
+            self.release()
+        return size
+
+    # Write data to the new file dest.
+    def write(self, dest, data):
+        self.acquire()
+        try:
+            with open(dest, "wb") as file:
+                self.allocate(file.fileno(), len(data))
+                file.write(data)
+        finally:
+            self.release()
+
+    def allocate(self, fd, size):
+        if not self.preallocate or size < self.block_size:
+            return False
+        if preallocate_file(fd, size):
+            return True
+        self.preallocate = False
+        return False
+
+    def copy_data(self, src_file, dest_file, size):
+        src_fd = src_file.fileno()
+        dest_fd = dest_file.fileno()
+        copied = 0
+        if self.copy_file_range:
+            try:
+                while True:
+                    sent = os.copy_file_range(src_fd, dest_fd,
+                                              self.CHUNK_SIZE)
+                    if not sent:
+                        return copied
+                    copied += sent
+            except OSError as e:
+                if copied or e.errno not in (errno.EXDEV, errno.ENOSYS,
+                                             errno.EINVAL, errno.EOPNOTSUPP,
+                                             errno.EBADF):
+                    raise
+                self.copy_file_range = False
+        if self.sendfile:
+            try:
+                while True:
+                    sent = os.sendfile(dest_fd, src_fd, copied,
+                                       self.CHUNK_SIZE)
+                    if not sent:
+                        return copied
+                    copied += sent
+            except OSError as e:
+                if copied or e.errno not in (errno.ENOSYS, errno.EINVAL,
+                                             errno.EOPNOTSUPP):
+                    raise
+                self.sendfile = False
+        buffer = bytearray(min(self.buffer_size, max(size, 1)))
+        view = memoryview(buffer)
+        while True:
+            length = src_file.readinto(buffer)
+            if not length:
+                return copied
+            written = 0
+            while written < length:
+                written += dest_file.write(view[written:length])
+            copied += length
+
+    def copy_permissions(self, fd, src_stat):
+        if not self.copy_mode or not hasattr(os, "fchmod"):
+            return
+        try:
+            os.fchmod(fd, stat.S_IMODE(src_stat.st_mode))
+        except OSError:
+            self.copy_mode = False
+
+    # Remember a file written to the destination. Once fsync_batch bytes
+    # were written, all files written since the last batch are flushed.
+    def written(self, path, size):
+        if not self.fsync_batch:
+            return
+        with self.lock:
+            self.pending.append(path)
+            self.pending_size += size
+            if self.pending_size < self.fsync_batch:
+                return
+            pending = self.pending
+            self.pending = []
+            self.pending_size = 0
+        self.sync_files(pending)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            self.pending_size = 0
+        self.sync_files(pending)
+
+    # Flush the files and the folders containing them, so their new names
+    # are stored as well.
+    @staticmethod
+    def sync_files(paths):
+        folders = sorted(set(os.path.dirname(path) for path in paths))
+        for path in paths + folders:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+
+# Read only file wrapper for probing audio headers. The first `size` bytes
+# are fetched with a single read and served from memory, only parsers looking
+# further into the file (e.g. past large embedded cover art) cause more
+# reads. This saves round-trips on network mounted music folders.
+class HeaderFile(io.RawIOBase):
+    def __init__(self, file, size):
+        super().__init__()
+        self.file = file
+        self.name = file.name
+        self.header = file.read(size)
+        self.size = os.fstat(file.fileno()).st_size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError("Negative seek position " + str(offset))
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        length = len(buffer)
+        data = self.header[self.position:self.position + length]
+        if len(data) < length and self.position + len(data) < self.size:
+            self.file.seek(self.position + len(data))
+            data += self.file.read(length - len(data))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+# Bitrate, duration and codec of an audio file. Fields are None if the file
+# can't be parsed.
+def read_audio_info(path):
+    import mutagen
+    try:
+        with open(path, "rb") as file:
+            audio = mutagen.File(HeaderFile(file, PROBE_SIZE))
+    except (OSError, mutagen.MutagenError):
+        audio = None
+    if audio is None:
+        return AudioInfo(None, None, None)
+    codec = getattr(audio.info, "codec", type(audio).__name__).lower()
+    if codec.startswith("mp4a"):
+        codec = "aac"
+    return AudioInfo(getattr(audio.info, "bitrate", None),
+                     audio.info.length, codec)
+
+
+# Persistent record of every file synced to a destination, stored as SQLite
+# database inside the destination folder. Entries are keyed by the source
+# path relative to the MPD music folder and remember the source's
+# (mtime, size, inode) together with the decision taken for it, so unchanged
+# files can be skipped on later runs without probing source or destination.
+# If a fingerprint algorithm is given, the content hash of the source is
+# recorded as well, so touched or moved files are not synced again.
+# Additionally, all files written to the destination by the last sync
+# (including album art) are stored as its outputs, so files to be removed
+# can be found without scanning the destination. For source folders, the
+# album art written for them is remembered with the folder's mtime, so
+# unchanged folders need not be listed again.
+class SyncManifest:
+    FILE_NAME = ".mpd-ps.db"
+    SCHEMA_VERSION = 3
+
+    Entry = namedtuple("Entry", ["src", "mtime", "size", "inode", "action",
+                                 "bitrate", "dest", "dest_size", "dest_mtime",
+                                 "src_hash", "length"])
+    # outputs: tuple of (path relative to dest_dir, content hash) pairs
+    Folder = namedtuple("Folder", ["src", "mtime", "outputs"])
+
+    # A read only manifest is never written to disk, e.g. for dry runs.
+    def __init__(self, dest_dir, settings, src_dir="", fingerprint=None,
+                 read_only=False):
+        self.dest_dir = dest_dir
+        self.src_dir = src_dir
+        self.fingerprint = fingerprint
+        self.read_only = read_only
+        self.path = os.path.join(dest_dir, self.FILE_NAME)
+        self.logger = logging.getLogger("mpd-ps")
+        self.pending = 0
+        self.entries = {}
+        self.meta = {}
+        self.folders = {}
+        # Paths relative to dest_dir, None if unknown
+        self.outputs = None
+        # Entries are recorded by the worker threads
+        self.lock = threading.Lock()
+        if read_only:
+            self.db = None
+            if os.path.exists(self.path):
+                from urllib.request import pathname2url
+                db = sqlite3.connect("file:" + pathname2url(self.path) +
+                                     "?mode=ro", uri=True)
+                if db.execute("PRAGMA user_version").fetchone()[0] == \
+                        self.SCHEMA_VERSION:
+                    self.meta = dict(db.execute("SELECT * FROM meta"))
+                    if self.meta.get("settings") == settings:
+                        self.entries = {row[0]: self.Entry(*row) for row in
+                                        db.execute("SELECT * FROM files")}
+                        self.folders = self.load_folders(db)
+                    if self.meta.get("outputs"):
+                        self.outputs = {row[0] for row in db.execute(
+                            "SELECT * FROM outputs")}
+                db.close()
+            return
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            if version:
+                self.logger.info("Manifest format changed. Rebuilding it.")
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute("DROP TABLE IF EXISTS meta")
+            self.db.execute("PRAGMA user_version = " +
+                            str(self.SCHEMA_VERSION))
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "src TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, "
+                        "inode INTEGER, action TEXT, bitrate INTEGER, "
+                        "dest TEXT, dest_size INTEGER, dest_mtime INTEGER, "
+                        "src_hash TEXT, length REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                        "key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outputs ("
+                        "path TEXT PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders ("
+                        "src TEXT PRIMARY KEY, mtime INTEGER, outputs TEXT)")
+        self.meta = dict(self.db.execute("SELECT * FROM meta"))
+        if self.meta.get("outputs"):
+            self.outputs = {row[0] for row in
+                            self.db.execute("SELECT * FROM outputs")}
+        # Decisions depend on the transcoding settings. If they changed since
+        # the last run, all entries are outdated.
+        if self.meta.get("settings") != settings:
+            if "settings" in self.meta:
+                self.logger.info("Transcoding settings changed. Discarding "
+                                 "manifest entries.")
+            self.clear()
+            self.set_meta("settings", settings)
+        self.entries = {row[0]: self.Entry(*row) for row in
+                        self.db.execute("SELECT * FROM files")}
+        self.folders = self.load_folders(self.db)
+        self.db.commit()
+
+    def load_folders(self, db):
+        folders = {}
+        for src, mtime, outputs in db.execute("SELECT * FROM folders"):
+            folders[src] = self.Folder(src, mtime, tuple(
+                tuple(line.split("\t")) for line in outputs.splitlines()))
+        return folders
+
+    # Files belonging to the manifest, which must survive the cleanup of the
+    # destination folder.
+    def files(self):
+        return {self.path, self.path + "-journal"}
+
+    def clear(self):
+        self.entries = {}
+        if self.db:
+            self.db.execute("DELETE FROM files")
+        self.clear_folders()
+
+    def clear_folders(self):
+        self.folders = {}
+        if self.db:
+            self.db.execute("DELETE FROM folders")
+
+    # Replace the outputs by the given absolute paths.
+    def set_outputs(self, paths):
+        self.outputs = set()
+        if self.db:
+            self.db.execute("DELETE FROM outputs")
+        self.add_outputs(paths)
+        self.set_meta("outputs", "1")
+
+    def add_outputs(self, paths):
+        paths = {os.path.relpath(path, self.dest_dir) for path in paths}
+        with self.lock:
+            if self.outputs is None:
+                return
+            self.outputs.update(paths)
+            if self.db:
+                self.db.executemany("INSERT OR IGNORE INTO outputs VALUES (?)",
+                                    ((path,) for path in paths))
+
+    def remove_outputs(self, paths):
+        paths = {os.path.relpath(path, self.dest_dir) for path in paths}
+        with self.lock:
+            if self.outputs is None:
+                return
+            self.outputs.difference_update(paths)
+            if self.db:
+                self.db.executemany("DELETE FROM outputs WHERE path = ?",
+                                    ((path,) for path in paths))
+
+    def get_meta(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.meta[key] = value
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                (key, value))
+
+    # Return the entry of src if the source file did not change since it was
+    # recorded, None otherwise.
+    def lookup(self, src, src_stat):
+        entry = self.entries.get(src)
+        if not entry or entry.size != src_stat.st_size:
+            return None
+        if entry.mtime == src_stat.st_mtime_ns and \
+                entry.inode == src_stat.st_ino:
+            return entry
+        # Touched or moved files with unchanged content are still in sync.
+        if self.fingerprint and entry.src_hash and entry.src_hash == \
+                get_fingerprint(os.path.join(self.src_dir, src),
+                                self.fingerprint):
+            self.logger.debug("Content of " + src + " is unchanged.")
+            self.store(entry._replace(mtime=src_stat.st_mtime_ns,
+                                      inode=src_stat.st_ino))
+            return entry
+        return None
+
+    # src_hash may be given if the fingerprint of src is known already.
+    def record(self, src, src_stat, action, bitrate, dest, length=None,
+               src_hash=None):
+        dest_stat = os.stat(dest)
+        if self.fingerprint and not src_hash:
+            src_hash = get_fingerprint(os.path.join(self.src_dir, src),
+                                       self.fingerprint)
+        elif not self.fingerprint:
+            src_hash = None
+        self.store(self.Entry(src, src_stat.st_mtime_ns, src_stat.st_size,
+                              src_stat.st_ino, action, bitrate,
+                              os.path.relpath(dest, self.dest_dir),
+                              dest_stat.st_size, dest_stat.st_mtime_ns,
+                              src_hash, length))
+
+    def store(self, entry):
+        with self.lock:
+            self.entries[entry.src] = entry
+            if not self.db:
+                return
+            self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entry)
+            # Commit in batches, so an interrupted sync keeps most of its
+            # work.
+            self.pending += 1
+            if self.pending >= 100:
+                self.db.commit()
+                self.pending = 0
+
+    def remove(self, src):
+        with self.lock:
+            self.entries.pop(src, None)
+            if self.db:
+                self.db.execute("DELETE FROM files WHERE src = ?", (src,))
+
+    # Return the folder entry of src if the folder did not change since it
+    # was recorded, None otherwise.
+    def lookup_folder(self, src, src_stat):
+        folder = self.folders.get(src)
+        if folder and folder.mtime == src_stat.st_mtime_ns:
+            return folder
+        return None
+
+    # outputs maps the absolute paths of the written files to their hashes.
+    def record_folder(self, src, src_stat, outputs):
+        folder = self.Folder(src, src_stat.st_mtime_ns, tuple(
+            (os.path.relpath(path, self.dest_dir), digest)
+            for path, digest in sorted(outputs.items())))
+        with self.lock:
+            self.folders[src] = folder
+            if self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+                    (src, folder.mtime, "\n".join(
+                        path + "\t" + digest
+                        for path, digest in folder.outputs)))
+
+    def remove_folder(self, src):
+        with self.lock:
+            self.folders.pop(src, None)
+            if self.db:
+                self.db.execute("DELETE FROM folders WHERE src = ?", (src,))
+
+    # Drop all entries whose destination file is missing or was modified
+    # outside of mpd-ps, so these files get synced again.
+    def check(self):
+        self.logger.info("Checking manifest against destination folder.")
+        stale = 0
+        for entry in list(self.entries.values()):
+            try:
+                dest_stat = os.stat(os.path.join(self.dest_dir, entry.dest))
+            except OSError:
+                dest_stat = None
+            if dest_stat is None or dest_stat.st_size != entry.dest_size or \
+                    dest_stat.st_mtime_ns != entry.dest_mtime:
+                self.logger.debug("Manifest entry " + entry.src +
+                                  " does not match destination. Dropping it.")
+                self.remove(entry.src)
+                stale += 1
+        for folder in list(self.folders.values()):
+            if not all(os.path.exists(os.path.join(self.dest_dir, path))
+                       for path, _ in folder.outputs):
+                self.remove_folder(folder.src)
+                stale += 1
+        self.commit()
+        self.logger.info("Dropped " + str(stale) + " stale manifest "
+                         "entries.")
+
+    def commit(self):
+        with self.lock:
+            if self.db:
+                self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        if self.db:
+            self.db.close()
+
+
+# Cache of encoded files, shared by all destinations and runs, so a wiped or
+# new device can be filled without encoding again. Files are stored by a key
+# derived from the content of the source and the encoder settings. An index
+# remembers size and last use of each file, the least recently used files
+# are evicted once the cache exceeds max_size bytes.
+class TranscodeCache:
+    INDEX_NAME = "index.db"
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.logger = logging.getLogger("mpd-ps")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.key_locks = {}
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, self.INDEX_NAME),
+                                  check_same_thread=False, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "name TEXT PRIMARY KEY, size INTEGER, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_used ON files "
+                        "(used)")
+        self.db.commit()
+
+    @staticmethod
+    def get_key(*parts):
+        return hashlib.blake2b("\0".join(str(part) for part in parts).encode(),
+                               digest_size=20).hexdigest()
+
+    # The extension tells ffmpeg the output format
+    def get_path(self, key, extension):
+        return os.path.join(self.path, key[:2], key + "." + extension)
+
+    # A new empty file to encode into. Every writer gets its own, as other
+    # workers or mpd-ps processes sharing the cache may encode the same key.
+    def get_temp_name(self, key, extension):
+        folder = os.path.join(self.path, key[:2])
+        os.makedirs(folder, exist_ok=True)
+        return create_temp_file(folder, MpdPs.TEMP_PREFIX + key + ".",
+                                "." + extension)
+
+    # Lock to hold while looking up and encoding key, so workers missing the
+    # same key wait for a single encode.
+    def get_key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    # Link or copy (with copy) the cached file of key to dest. Returns False
+    # on a cache miss.
+    def fetch(self, key, extension, dest, count=True, copy=shutil.copyfile):
+        path = self.get_path(key, extension)
+        found = link_file(path, dest, copy)
+        with self.lock:
+            if count:
+                self.hits += 1 if found else 0
+                self.misses += 0 if found else 1
+            if found:
+                self.db.execute("UPDATE files SET used = ? WHERE name = ?",
+                                (time.time(), os.path.basename(path)))
+                self.db.commit()
+        return found
+
+    # Add the encoded file temp_name to the cache as key and evict the least
+    # recently used files beyond the size limit.
+    def store(self, key, extension, temp_name):
+        path = self.get_path(key, extension)
+        os.replace(temp_name, path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                            (os.path.basename(path), os.path.getsize(path),
+                             time.time()))
+            size = self.db.execute("SELECT SUM(size) FROM files").fetchone()[0]
+            while size > self.max_size:
+                name, file_size = self.db.execute(
+                    "SELECT name, size FROM files ORDER BY used "
+                    "LIMIT 1").fetchone()
+                if name == os.path.basename(path):
+                    break
+                self.logger.debug("Evicting " + name + " from transcode "
+                                                       "cache.")
+                try:
+                    os.remove(os.path.join(self.path, name[:2], name))
+                except FileNotFoundError:
+                    pass
+                self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+                size -= file_size
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Transcoding jobs waiting for a worker, ordered by their estimated cost.
+# Workers always take the most expensive job, so a long album found late in
+# the playlist doesn't end up as the tail of the run with all other workers
+# idle.
+class JobQueue:
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, job):
+        with self.condition:
+            heapq.heappush(self.heap, (-job.cost, next(self.counter), job))
+            self.condition.notify()
+
+    # Return the most expensive job, or None once the queue is closed and
+    # empty.
+    def get(self):
+        with self.condition:
+            while not self.heap and not self.closed:
+                self.condition.wait()
+            return heapq.heappop(self.heap)[2] if self.heap else None
+
+    def __len__(self):
+        return len(self.heap)
+
+    # No more jobs will be added.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Thread pool with a bounded backlog. submit() blocks while the backlog is
+# full, so the playlist walk can't run arbitrarily far ahead of the workers.
+class WorkerPool:
+    def __init__(self, name, workers, backlog):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix=name)
+        self.slots = threading.Semaphore(workers + backlog)
+        self.logger = logging.getLogger("mpd-ps")
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    # Number of submitted tasks not finished yet
+    def __len__(self):
+        return self.pending
+
+    def submit(self, task, *args):
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(task, *args)
+        future.add_done_callback(self.task_done)
+        return future
+
+    def task_done(self, future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+        if not future.cancelled() and future.exception():
+            self.logger.error("Worker failed.", exc_info=future.exception())
+
+    # Wait for all submitted tasks to finish.
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+# Timings and throughput of a sync. Workers record each finished task with
+# its phase, size and duration; busy time and throughput are accumulated per
+# phase and per worker thread. While a sync runs, a reporter thread samples
+# the queue depths, estimates the remaining time and draws a progress bar
+# and/or passes progress events to the callbacks. The results can be written
+# as JSON lines events and as Prometheus textfile.
+class SyncMetrics:
+    PHASES = ("playlist", "probe", "copy", "transcode", "art", "prune")
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.events = None
+        self.progress = False
+        # Functions called with each event as dict
+        self.callbacks = []
+        self.prometheus_file = None
+        self.logger = logging.getLogger("mpd-ps")
+        self.lock = threading.Lock()
+        self.reporter = None
+        self.stopped = threading.Event()
+        self.queues = {}
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.phases = {phase: self.Stats() for phase in self.PHASES}
+        self.workers = collections.defaultdict(self.Stats)
+        self.queue_depths = collections.defaultdict(int)
+        self.items = 0
+        self.walked = 0
+        self.counters = collections.Counter()
+        self.queued = 0
+        self.queued_copy_size = 0
+        self.queued_cost = 0
+        self.done_cost = 0
+
+    class Stats:
+        def __init__(self):
+            self.files = 0
+            self.bytes = 0
+            self.failed = 0
+            # Sum of the durations of all tasks
+            self.busy = 0.0
+            self.cpu = 0.0
+            self.first = None
+            self.last = None
+
+        # Time from the start of the first to the end of the last task
+        def span(self):
+            return self.last - self.first if self.first is not None else 0.0
+
+        def to_dict(self):
+            span = self.span()
+            return {"files": self.files, "bytes": self.bytes,
+                    "failed": self.failed, "busy_seconds": round(self.busy, 3),
+                    "seconds": round(span, 3),
+                    "cpu_seconds": round(self.cpu, 3),
+                    "bytes_per_second": round(self.bytes / span) if span else
+                    0, "files_per_second": round(self.files / span, 2) if
+                    span else 0}
+
+    def start(self):
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+
+    def emit(self, event, **fields):
+        if not self.events and not self.callbacks:
+            return
+        fields = dict({"time": round(time.time(), 3), "event": event},
+                      **fields)
+        if self.events:
+            with self.lock:
+                self.events.write(json.dumps(fields) + "\n")
+                self.events.flush()
+        self.notify(fields)
+
+    def notify(self, fields):
+        for callback in self.callbacks:
+            callback(fields)
+
+    # Record a finished task of phase, started at the given monotonic time.
+    def record(self, phase, started, size=0, cpu=0.0, failed=False,
+               name=None):
+        self.start()
+        end = time.monotonic()
+        worker = threading.current_thread().name
+        with self.lock:
+            for stats in (self.phases[phase], self.workers[(phase, worker)]):
+                stats.files += 0 if failed else 1
+                stats.failed += 1 if failed else 0
+                stats.bytes += size
+                stats.busy += end - started
+                stats.cpu += cpu
+                stats.first = started if stats.first is None else \
+                    min(stats.first, started)
+                stats.last = end if stats.last is None else \
+                    max(stats.last, end)
+        if name is not None and phase != "probe":
+            self.emit(phase, name=name, worker=worker, bytes=size,
+                      seconds=round(end - started, 3), cpu_seconds=round(
+                          cpu, 3), failed=failed)
+
+    # Announce work queued for a worker pool, for the remaining time.
+    def queue(self, size=0, cost=0):
+        with self.lock:
+            self.queued += 1
+            self.queued_copy_size += size
+            self.queued_cost += cost
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def transcoded(self, cost):
+        with self.lock:
+            self.done_cost += cost
+
+    # Start the reporter of a sync of items. queues maps names to objects
+    # supporting len(). Syncs of several targets add up until finish().
+    def begin_sync(self, items, queues):
+        self.start()
+        self.items += items
+        self.queues = queues
+        if self.reporter:
+            return
+        self.stopped.clear()
+        self.reporter = threading.Thread(target=self.report,
+                                         name="mpd-ps-metrics", daemon=True)
+        self.reporter.start()
+
+    # Count items checked by the playlist walk
+    def walk(self, items=1):
+        with self.lock:
+            self.walked += items
+
+    def report(self):
+        while not self.stopped.wait(self.INTERVAL):
+            for name, queue in self.queues.items():
+                self.queue_depths[name] = max(self.queue_depths[name],
+                                              len(queue))
+            if self.progress:
+                self.draw_progress()
+            if self.callbacks:
+                self.notify(dict({"time": round(time.time(), 3),
+                                  "event": "progress"}, **self.get_progress()))
+        if self.progress:
+            sys.stderr.write("\r\x1b[K")
+            sys.stderr.flush()
+
+    # Remaining time of the sync. The transcoding time is extrapolated from
+    # the encoded cost, the copying time from the copied bytes, and both are
+    # scaled up while the playlist walk is still running.
+    def get_eta(self):
+        with self.lock:
+            transcode = self.phases["transcode"]
+            copy = self.phases["copy"]
+            eta = 0.0
+            if self.done_cost and transcode.span():
+                eta = (self.queued_cost - self.done_cost) * \
+                    transcode.span() / self.done_cost
+            if copy.bytes and copy.span():
+                eta = max(eta, (self.queued_copy_size - copy.bytes) *
+                          copy.span() / copy.bytes)
+            if self.walked and self.walked < self.items:
+                eta *= self.items / self.walked
+            return eta
+
+    # Checked and written files, copy speed and remaining time of the
+    # running sync.
+    def get_progress(self):
+        with self.lock:
+            done = self.phases["copy"].files + self.phases["copy"].failed + \
+                self.phases["transcode"].files + \
+                self.phases["transcode"].failed
+            copied = self.phases["copy"]
+            speed = copied.bytes / copied.span() if copied.span() else 0
+        # The walk is fast compared to the workers, so the progress follows
+        # the queued files once they are known.
+        fraction = self.walked / self.items if self.items else 1.0
+        if self.queued:
+            fraction *= done / self.queued
+        return {"checked": self.walked, "items": self.items, "written": done,
+                "queued": self.queued, "fraction": round(fraction, 4),
+                "bytes_per_second": round(speed),
+                "eta_seconds": round(self.get_eta(), 1)}
+
+    def draw_progress(self):
+        progress = self.get_progress()
+        width = 30
+        filled = int(width * progress["fraction"])
+        bar = "#" * filled + "." * (width - filled)
+        sys.stderr.write("\r\x1b[K[" + bar + "] " +
+                         str(progress["checked"]) + "/" +
+                         str(progress["items"]) + " checked, " +
+                         str(progress["written"]) + "/" +
+                         str(progress["queued"]) + " written, " +
+                         str(round(progress["bytes_per_second"] /
+                                   (1024 * 1024), 1)) + " MB/s, ETA " +
+                         MpdPs.format_duration(progress["eta_seconds"]))
+        sys.stderr.flush()
+
+    # End of a sync: stop the reporter, log and write the results and start
+    # over for the next sync.
+    def finish(self, success):
+        if self.reporter:
+            self.stopped.set()
+            self.reporter.join()
+            self.reporter = None
+        total = time.monotonic() - self.started if self.started else 0.0
+        summary = {"success": success, "seconds": round(total, 3),
+                   "phases": {phase: stats.to_dict() for phase, stats in
+                              self.phases.items()},
+                   "workers": {phase + "/" + worker: stats.to_dict() for
+                               (phase, worker), stats in
+                               sorted(self.workers.items())},
+                   "queue_depths": dict(self.queue_depths),
+                   "counters": dict(self.counters)}
+        for phase, stats in self.phases.items():
+            if phase == "playlist" and stats.files:
+                self.logger.info("Phase playlist: " +
+                                 str(round(stats.span(), 2)) + "s.")
+            elif stats.files or stats.failed:
+                self.logger.info(
+                    "Phase " + phase + ": " + str(stats.files) + " files, " +
+                    str(round(stats.bytes / (1024 * 1024), 2)) + " MB in " +
+                    str(round(stats.span(), 2)) + "s (" +
+                    str(summary["phases"][phase]["files_per_second"]) +
+                    " files/s).")
+        for counter, value in sorted(self.counters.items()):
+            self.logger.info(counter.replace("_", " ").capitalize() + ": " +
+                             str(value))
+        self.emit("summary", **summary)
+        if self.prometheus_file:
+            self.write_prometheus(summary)
+        self.reset()
+
+    def write_prometheus(self, summary):
+        lines = ["# TYPE mpd_ps_last_run_timestamp_seconds gauge",
+                 "mpd_ps_last_run_timestamp_seconds " + str(round(
+                     time.time())),
+                 "# TYPE mpd_ps_last_run_success gauge",
+                 "mpd_ps_last_run_success " + str(int(summary["success"])),
+                 "# TYPE mpd_ps_last_run_seconds gauge",
+                 "mpd_ps_last_run_seconds " + str(summary["seconds"])]
+        metrics = (("phase_seconds", "seconds"),
+                   ("phase_busy_seconds", "busy_seconds"),
+                   ("phase_cpu_seconds", "cpu_seconds"),
+                   ("phase_files", "files"), ("phase_failed", "failed"),
+                   ("phase_bytes", "bytes"))
+        for metric, key in metrics:
+            lines.append("# TYPE mpd_ps_" + metric + " gauge")
+            for phase, stats in summary["phases"].items():
+                lines.append("mpd_ps_" + metric + '{phase="' + phase + '"} ' +
+                             str(stats[key]))
+        for counter, value in sorted(summary["counters"].items()):
+            lines.append("# TYPE mpd_ps_" + counter + " gauge")
+            lines.append("mpd_ps_" + counter + " " + str(value))
+        lines.append("# TYPE mpd_ps_queue_depth_max gauge")
+        for queue, depth in summary["queue_depths"].items():
+            lines.append('mpd_ps_queue_depth_max{queue="' + queue + '"} ' +
+                         str(depth))
+        # Written atomically, the node exporter may read it any time
+        temp_name = self.prometheus_file + ".tmp"
+        try:
+            with open(temp_name, "w") as file:
+                file.write("\n".join(lines) + "\n")
+            os.replace(temp_name, self.prometheus_file)
+        except OSError as e:
+            self.logger.error("Writing metrics to " + self.prometheus_file +
+                              " failed: " + str(e))
+
+
+# Paths removed from the destination by pruning, in order of removal. Their
+# keys (see MpdPs.normalize_path) are kept in a set, so checking the
+# siblings of pruned files doesn't get slower with every removed file.
+class RemovedPaths(list):
+    def __init__(self, normalize):
+        super().__init__()
+        self.normalize = normalize
+        self.keys = set()
+
+    def append(self, path):
+        super().append(path)
+        self.keys.add(self.normalize(path))
+
+    def __contains__(self, path):
+        return self.normalize(path) in self.keys
+
+
+# A file operation of a sync: "copy" or "transcode" the playlist item name
+# from src to dest, or copy the album art of the folder src to the folder
+# dest ("art").
+SyncAction = namedtuple("SyncAction", ["kind", "name", "src", "dest",
+                                       "src_stat", "bitrate", "length",
+                                       "codec"])
+
+
+# The actions of a sync of items to one target, and the destination files
+# it keeps. Finished actions are marked done, so a cancelled sync can be
+# resumed by running the plan again.
+class TargetPlan:
+    def __init__(self, target, items, full):
+        self.target = target
+        self.items = items
+        # A sync of the whole playlist removes other files
+        self.full = full
+        self.actions = []
+        self.added_files = set()
+        self.folders = {}
+        # Synced file of each playlist item, for the .m3u files
+        self.dest_names = {}
+        # Manifest entries of files found up to date, recorded when the plan
+        # runs, so planning doesn't write to the destination
+        self.records = []
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def mark_done(self, dest):
+        with self.lock:
+            self.done.add(dest)
+
+    def remaining(self):
+        with self.lock:
+            return [action for action in self.actions
+                    if action.dest not in self.done]
+
+
+# Plan of a sync to all targets, see SyncEngine.
+class SyncPlan:
+    def __init__(self, targets):
+        self.targets = targets
+
+    # The plan of target, an MpdPs instance.
+    def get(self, target):
+        for plan in self.targets:
+            if plan.target is target:
+                return plan
+        return None
+
+    def get_actions(self, kind=None):
+        return [action for plan in self.targets for action in plan.actions
+                if kind is None or action.kind == kind]
+
+    def remaining(self):
+        return [action for plan in self.targets
+                for action in plan.remaining()]
+
+    def is_complete(self):
+        return not self.remaining()
+
+    # Number of files to copy and transcode, their size and duration, and the
+    # number of album art folders, by target name.
+    def summary(self):
+        summary = {}
+        for plan in self.targets:
+            copies = [action for action in plan.actions
+                      if action.kind == "copy"]
+            transcodes = [action for action in plan.actions
+                          if action.kind == "transcode"]
+            summary[plan.target.name] = {
+                "items": len(plan.items), "copies": len(copies),
+                "copy_bytes": sum(action.src_stat.st_size
+                                  for action in copies),
+                "transcodes": len(transcodes),
+                "transcode_seconds": round(sum(action.length or 0 for action
+                                               in transcodes), 1),
+                "art_folders": len(plan.actions) - len(copies) -
+                len(transcodes),
+                "remaining": len(plan.remaining())}
+        return summary
+
+
+class MpdPs:
+    TEMP_PREFIX = ".mpd-ps-part."
+    PLAYLIST_INFO_BATCH = 1000
+    # Relative decoding cost of the source codecs
+    CODEC_COST = {"flac": 1.0, "alac": 1.0, "mp3": 1.2, "aac": 1.3}
+    # Seconds per worker to encode one second of audio, until measured
+    ENCODE_RATE = {"opus": 0.02, "ogg": 0.03, "mp3": 0.025}
+
+    Probe = namedtuple("Probe", ["name", "stat", "entry", "info"])
+
+    class TranscodingJob:
+        def __init__(self, src, dest, name=None, src_stat=None, bitrate=None):
+            self.src = src
+            self.dest = dest
+            self.temp = None
+            self.name = name
+            self.src_stat = src_stat
+            self.bitrate = bitrate
+            # Duration in seconds and estimated encoding cost
+            self.length = 0
+            self.cost = 0
+            # Outcome of the last attempt
+            self.attempts = 0
+            self.returncode = None
+            self.timed_out = False
+            self.output = []
+            self.cpu_time = 0.0
+
+    # Files are written to a temporary file next to their destination first
+    # and renamed when complete, so interrupted syncs never leave truncated
+    # files behind. The audio file extension is kept for ffmpeg.
+    @staticmethod
+    def get_temp_name(dest):
+        return os.path.join(os.path.dirname(dest),
+                            MpdPs.TEMP_PREFIX + os.path.basename(dest))
+
+    def remove_temp_file(self, temp_name):
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass
+
+    def get_ffmpeg_command(self, job):
+        command = [self.ffmpeg, "-y", "-hide_banner", "-nostats", "-i",
+                   job.src, "-vn", "-c:a"]
+        if self.audio_format == "ogg":
+            command += ["libvorbis", "-q", str(self.audio_quality_vorbis)]
+        elif self.audio_format == "mp3":
+            command += ["libmp3lame", "-q", str(self.audio_quality_lame)]
+        elif self.audio_format == "opus":
+            command += ["libopus", "-b", str(self.audio_quality_opus)]
+        return command + [job.temp]
+
+    # Encoder and quality, files encoded with the same settings are
+    # interchangeable.
+    def get_encoder_settings(self):
+        if self.audio_format == "ogg":
+            return self.audio_format, self.audio_quality_vorbis
+        elif self.audio_format == "mp3":
+            return self.audio_format, self.audio_quality_lame
+        return self.audio_format, self.audio_quality_opus
+
+    # Run ffmpeg once for job. Its output is drained while it runs and only
+    # the last lines are kept for error messages. Encoders running longer
+    # than transcode_timeout are killed.
+    def run_encoder(self, job):
+        job.attempts += 1
+        job.timed_out = False
+        output = collections.deque(maxlen=10)
+        try:
+            process = subprocess.Popen(self.get_ffmpeg_command(job),
+                                       stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE,
+                                       universal_newlines=True,
+                                       errors="replace",
+                                       start_new_session=True)
+        except OSError as e:
+            job.returncode = None
+            job.output = [str(e)]
+            return False
+
+        def kill():
+            job.timed_out = True
+            self.kill_encoder(process)
+
+        timer = threading.Timer(self.transcode_timeout, kill) \
+            if self.transcode_timeout > 0 else None
+        if timer:
+            timer.start()
+        with self.lock:
+            self.encoders.add(process)
+        try:
+            for line in process.stderr:
+                output.append(line.rstrip())
+            job.returncode = self.wait_encoder(process, job)
+        finally:
+            if timer:
+                timer.cancel()
+            with self.lock:
+                self.encoders.discard(process)
+            process.stderr.close()
+        job.output = list(output)
+        return job.returncode == 0 and not job.timed_out
+
+    # Kill the whole process group, so no child keeps the output pipe open.
+    @staticmethod
+    def kill_encoder(process):
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    # Wait for the encoder to exit and add its CPU time to the job, where
+    # the platform reports it per process.
+    @staticmethod
+    def wait_encoder(process, job):
+        if not hasattr(os, "wait4") or \
+                not hasattr(os, "waitstatus_to_exitcode"):
+            return process.wait()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        job.cpu_time += usage.ru_utime + usage.ru_stime
+        return process.returncode
+
+    # Jobs of files which couldn't be probed are estimated from their size,
+    # assuming 1 MBit/s.
+    def create_transcoding_job(self, src, dest, name, src_stat, bitrate,
+                               length, codec):
+        job = self.TranscodingJob(src, dest, name, src_stat, bitrate)
+        job.length = length if length is not None else \
+            src_stat.st_size * 8 / 1000000
+        job.cost = job.length * self.CODEC_COST.get(codec, 1.0)
+        return job
+
+    # Seconds per worker to encode one second of audio, as measured by the
+    # last run.
+    def get_encode_rate(self):
+        rate = self.manifest.get_meta("encode_rate:" + self.audio_format) \
+            if self.manifest else None
+        return float(rate) if rate else self.ENCODE_RATE[self.audio_format]
+
+    def transcode_worker(self):
+        while True:
+            job = self.transcode_queue.get()
+            if job is None:
+                return
+            if self.cancelled.is_set():
+                continue
+            start_time = time.monotonic()
+            try:
+                self.transcode_file(job)
+            except Exception as e:
+                # A broken job must not take the worker and its later jobs
+                # down with it
+                self.logger.error("Encoding " + job.src + " failed.",
+                                  exc_info=e)
+                if job.temp:
+                    self.remove_temp_file(job.temp)
+                job.returncode = None
+                job.output = [type(e).__name__ + ": " + str(e)]
+                self.metrics.record("transcode", start_time, failed=True,
+                                    name=job.dest)
+                with self.lock:
+                    self.failed_jobs.append(job)
+
+    # Transcoding worker: encode the file, retrying failed encoders, and move
+    # the output to its destination.
+    def transcode_file(self, job):
+        self.logger.debug("Encoding file:" + job.dest)
+        dest_temp = self.get_temp_name(job.dest)
+        job.temp = dest_temp
+        start_time = time.monotonic()
+        key = (job.src, job.src_stat.st_mtime_ns, job.src_stat.st_size,
+               self.get_encoder_settings())
+        with self.lock:
+            encoded = self.encodes.get(key)
+        shared = encoded is not None and \
+            link_file(encoded, dest_temp, self.writer.copy)
+        if shared:
+            self.logger.debug("Using file encoded for another target: " +
+                              encoded)
+        src_hash = None
+        if shared:
+            success = True
+        elif self.transcode_cache:
+            src_hash, cache_key = self.get_cache_key(job)
+            with self.transcode_cache.get_key_lock(cache_key):
+                shared = self.transcode_cache.fetch(
+                    cache_key, self.audio_format, dest_temp,
+                    copy=self.writer.copy)
+                self.metrics.count("transcode_cache_hits" if shared else
+                                   "transcode_cache_misses")
+                if shared:
+                    self.logger.debug("Using cached encode of " + job.src)
+                    success = True
+                else:
+                    success = self.encode_into_cache(job, cache_key,
+                                                     dest_temp)
+        else:
+            success = self.encode_staged(job, dest_temp)
+        if not success and self.cancelled.is_set():
+            self.remove_temp_file(job.temp)
+            return
+        if success:
+            os.replace(job.temp, job.dest)
+            self.writer.written(job.dest, os.path.getsize(job.dest))
+            if self.manifest:
+                self.manifest.record(job.name, job.src_stat, "transcode",
+                                     job.bitrate, job.dest, job.length,
+                                     src_hash)
+            with self.lock:
+                self.encodes[key] = job.dest
+            self.plan.mark_done(job.dest)
+        else:
+            self.remove_temp_file(job.temp)
+            self.logger.error("Encoding " + job.src + " failed (" +
+                              self.get_job_status(job) + ").")
+        self.metrics.transcoded(job.cost)
+        self.metrics.record("transcode", start_time, os.path.getsize(
+            job.dest) if success else 0, job.cpu_time, not success, job.dest)
+        with self.lock:
+            if success:
+                self.transcoded_files += 1
+            else:
+                self.failed_jobs.append(job)
+            # Only actual encodes tell the encoding speed
+            if success and not shared:
+                self.encode_time += time.monotonic() - start_time
+                self.encoded_cost += job.cost
+            done = self.transcoded_files + len(self.failed_jobs)
+            total = self.transcode_jobs_size
+        if done % 10 == 0:
+            self.logger.info("Encoded " + str(done) + "/" + str(total) +
+                             " queued files.")
+
+    # Fingerprint of the source of job and the key of its encoded file in
+    # the transcode cache.
+    def get_cache_key(self, job):
+        src_hash = get_fingerprint(job.src, self.fingerprint or "blake2")
+        return src_hash, TranscodeCache.get_key(
+            src_hash, *self.get_encoder_settings(), self.get_ffmpeg_version())
+
+    # Run the encoder for job, retrying failed encoders. Returns whether it
+    # succeeded.
+    def encode(self, job):
+        while True:
+            success = self.run_encoder(job)
+            if success or job.returncode is None or \
+                    job.attempts > self.transcode_retries or \
+                    self.cancelled.is_set():
+                return success
+            self.logger.warning("Encoding " + job.src + " failed (" +
+                                self.get_job_status(job) + "). Retrying.")
+
+    # Encode job into the local staging folder and copy the result to
+    # dest_temp, so the encoders don't write to the destination directly.
+    def encode_staged(self, job, dest_temp):
+        job.temp = create_temp_file(self.staging_dir, self.TEMP_PREFIX,
+                                    "." + self.audio_format)
+        success = self.encode(job)
+        if success:
+            try:
+                success = link_file(job.temp, dest_temp, self.writer.copy)
+            except OSError as e:
+                job.output = [str(e)]
+                success = False
+        self.remove_temp_file(job.temp)
+        job.temp = dest_temp
+        return success
+
+    # Encode job into the transcode cache, the destination gets a copy.
+    def encode_into_cache(self, job, cache_key, dest_temp):
+        job.temp = self.transcode_cache.get_temp_name(cache_key,
+                                                      self.audio_format)
+        success = self.encode(job)
+        if success:
+            success = self.store_in_cache(job, cache_key, dest_temp)
+        else:
+            self.remove_temp_file(job.temp)
+        job.temp = dest_temp
+        return success
+
+    # Move the file encoded for job into the transcode cache and copy it to
+    # dest_temp.
+    def store_in_cache(self, job, cache_key, dest_temp):
+        try:
+            self.transcode_cache.store(cache_key, self.audio_format,
+                                       job.temp)
+            return self.transcode_cache.fetch(cache_key, self.audio_format,
+                                              dest_temp, count=False,
+                                              copy=self.writer.copy)
+        except OSError as e:
+            self.remove_temp_file(job.temp)
+            job.output = [str(e)]
+            return False
+
+    def get_ffmpeg_version(self):
+        if self.ffmpeg_version is None:
+            try:
+                output = subprocess.run([self.ffmpeg, "-version"],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        universal_newlines=True).stdout
+            except OSError:
+                output = ""
+            self.ffmpeg_version = output.split("\n")[0]
+        return self.ffmpeg_version
+
+    # Default location of the transcode cache
+    @staticmethod
+    def get_cache_dir():
+        if platform.system() == "Windows":
+            base = os.getenv("LOCALAPPDATA") or os.path.expanduser("~")
+        else:
+            base = os.getenv("XDG_CACHE_HOME") or os.path.join(
+                os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "mpd-ps", "transcodes")
+
+    @staticmethod
+    def get_job_status(job):
+        if job.timed_out:
+            status = "timed out"
+        elif job.returncode is None:
+            status = "encoder not started"
+        else:
+            status = "exit code " + str(job.returncode)
+        if job.output:
+            status += ": " + job.output[-1]
+        return status
+
+    # I/O worker: copy a file to the destination.
+    def copy_file(self, src_relative_name, src_stat, bitrate, length, src,
+                  dest):
+        if self.cancelled.is_set():
+            return
+        start_time = time.monotonic()
+        temp_name = self.get_temp_name(dest)
+        try:
+            size = self.writer.copy(src, temp_name)
+            os.replace(temp_name, dest)
+            self.writer.written(dest, size)
+            self.logger.debug("Copied file to: " + dest)
+            if self.manifest:
+                self.manifest.record(src_relative_name, src_stat, "copy",
+                                     bitrate, dest, length)
+            self.plan.mark_done(dest)
+        except OSError:
+            self.remove_temp_file(temp_name)
+            self.logger.error("Copying " + src + " to " + dest +
+                              " failed. Skipping file.")
+            self.metrics.record("copy", start_time, failed=True, name=dest)
+            return
+        self.metrics.record("copy", start_time, src_stat.st_size, name=dest)
+
+    # Remember the destination of a source folder. For new folders, yields
+    # the action copying their album art, unless the manifest knows it from
+    # the last sync.
+    def add_folder(self, plan, src_path, dest_path):
+        if src_path in plan.folders:
+            return
+        plan.folders[src_path] = dest_path
+        if not self.will_copy_album_art:
+            return
+        src_folder = os.path.relpath(src_path, self.mpd_root_dir)
+        folder = None
+        if self.manifest:
+            try:
+                folder = self.manifest.lookup_folder(src_folder,
+                                                     os.stat(src_path))
+            except OSError:
+                pass
+        if folder:
+            plan.added_files.update(os.path.join(self.dest_dir, path)
+                                    for path, _ in folder.outputs)
+            return
+        action = SyncAction("art", src_folder, src_path, dest_path, None,
+                            None, None, None)
+        plan.actions.append(action)
+        yield action
+
+    # Check whether dest is a complete and current copy or transcode of src.
+    def is_up_to_date(self, src, src_stat, dest, transcoded, length=None):
+        try:
+            dest_stat = os.stat(dest)
+        except OSError:
+            return False
+        if dest_stat.st_mtime_ns < src_stat.st_mtime_ns:
+            return False
+        if not transcoded:
+            return dest_stat.st_size == src_stat.st_size
+        # Encoders killed by older versions left truncated files behind,
+        # which are shorter than their source.
+        if length is None:
+            length = read_audio_info(src).length
+        dest_length = read_audio_info(dest).length
+        if length is None or dest_length is None:
+            return False
+        return abs(length - dest_length) < 1
+
+    # Key for comparing destination paths. File systems differ in unicode
+    # normalization, and on case insensitive file systems (FAT, exFAT) names
+    # differing in case denote the same file.
+    def normalize_path(self, path):
+        path = unicodedata.normalize("NFC", os.path.normcase(
+            os.path.normpath(path)))
+        return path.casefold() if self.dest_case_insensitive else path
+
+    @staticmethod
+    def is_case_insensitive(path):
+        with tempfile.NamedTemporaryFile(prefix=".mpd-ps-case.",
+                                         dir=path) as file:
+            return os.path.exists(os.path.join(
+                path, os.path.basename(file.name).upper()))
+
+    # Remove a file or empty folder from the destination. Only reported with
+    # --dry-run or --prune-dry-run.
+    def prune(self, path, removed, folder=False):
+        removed.append(path)
+        if self.dry_run or self.prune_dry_run:
+            self.logger.info("Would remove: " + path)
+            return
+        self.logger.debug("Removing " + path + ", it is not in playlist any "
+                                               "more.")
+        start_time = time.monotonic()
+        try:
+            if folder:
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        if not folder:
+            self.metrics.record("prune", start_time, name=path)
+
+    # Remove the outputs of the last sync which are not to be kept, and the
+    # folders becoming empty by this.
+    def prune_outputs(self, outputs, keep, removed):
+        folders = set()
+        for output in sorted(outputs):
+            path = os.path.join(self.dest_dir, output)
+            if self.normalize_path(path) not in keep:
+                self.prune(path, removed)
+                folders.add(os.path.dirname(path))
+        # Deepest folders first, so their parents can become empty
+        for folder in sorted(folders, key=len, reverse=True):
+            self.remove_empty_parents(folder, removed)
+
+    # Single bottom-up pass over path, removing all files not to be kept and
+    # all folders becoming empty by this. Returns whether path is empty now.
+    def prune_tree(self, path, keep, removed):
+        empty = True
+        with os.scandir(path) as entries:
+            entries = list(entries)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if self.prune_tree(entry.path, keep, removed):
+                    self.prune(entry.path, removed, folder=True)
+                else:
+                    empty = False
+            elif self.normalize_path(entry.path) in keep:
+                empty = False
+            else:
+                self.prune(entry.path, removed)
+        return empty
+
+    # Remove folder and its parents up to the destination folder as long as
+    # they are empty. With orphaned_art, folders only containing album art
+    # count as empty. Temp files left by interrupted syncs are removed on
+    # the way, they are never part of the outputs.
+    def remove_empty_parents(self, folder, removed, orphaned_art=False):
+        while folder != self.dest_dir and \
+                folder.startswith(self.dest_dir + os.sep):
+            try:
+                files = [file for file in os.listdir(folder)
+                         if os.path.join(folder, file) not in removed]
+            except OSError:
+                return
+            for file in files:
+                if file.startswith(self.TEMP_PREFIX):
+                    self.prune(os.path.join(folder, file), removed)
+            files = [file for file in files
+                     if not file.startswith(self.TEMP_PREFIX)]
+            if not orphaned_art and files or \
+                    any(not self.is_album_art(file) for file in files):
+                return
+            for file in files:
+                self.prune(os.path.join(folder, file), removed)
+            self.prune(folder, removed, folder=True)
+            folder = os.path.dirname(folder)
+
+    @staticmethod
+    def is_album_art(file):
+        return os.path.splitext(file)[1].lower() in ALBUM_ART_EXTENSIONS
+
+    def get_album_art_name(self, file):
+        if self.album_art_jpeg:
+            return os.path.splitext(file)[0] + ".jpg"
+        return file
+
+    # I/O worker: copy the image files (jpg,png,gif) of folder to the
+    # destination. Folders which did not change since the last sync are
+    # skipped.
+    def copy_album_art(self, added_files, folder, dest_folder):
+        if self.cancelled.is_set():
+            return
+        src_folder = os.path.relpath(folder, self.mpd_root_dir)
+        try:
+            folder_stat = os.stat(folder)
+            files = sorted(os.listdir(folder)) if not self.manifest or \
+                not self.manifest.lookup_folder(src_folder, folder_stat) \
+                else None
+        except OSError:
+            return
+        if files is None:
+            added_files.update(os.path.join(self.dest_dir, path) for path, _
+                               in self.manifest.folders[src_folder].outputs)
+            self.plan.mark_done(dest_folder)
+            return
+        outputs = {}
+        complete = True
+        for file in files:
+            if not self.is_album_art(file):
+                continue
+            image_src = os.path.join(folder, file)
+            image_dest = os.path.join(dest_folder,
+                                      self.get_album_art_name(file))
+            if image_dest in outputs:
+                self.logger.debug("Album art " + image_dest + " exists in "
+                                  "other format. Skipping " + image_src)
+                continue
+            added_files.add(image_dest)
+            start_time = time.monotonic()
+            try:
+                outputs[image_dest] = self.write_album_art(image_src,
+                                                           image_dest)
+            except OSError as e:
+                self.logger.error("Copying album art " + image_src +
+                                  " failed: " + str(e))
+                self.metrics.record("art", start_time, failed=True,
+                                    name=image_dest)
+                complete = False
+        if self.manifest and complete:
+            self.manifest.record_folder(src_folder, folder_stat, outputs)
+        if complete:
+            self.plan.mark_done(dest_folder)
+
+    # Write the album art image_src to image_dest, unless it is up to date,
+    # and return the hash of its content. Identical images are written once,
+    # further copies are hard links to it where the file system allows.
+    def write_album_art(self, image_src, image_dest):
+        start_time = time.monotonic()
+        with open(image_src, "rb") as file:
+            data = file.read()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        try:
+            if not self.album_art_changed and os.stat(
+                    image_dest).st_mtime_ns >= os.stat(image_src).st_mtime_ns:
+                self.logger.debug("Album art exists: " + image_dest)
+                self.add_album_art(digest, image_dest)
+                return digest
+        except OSError:
+            pass
+        with self.lock:
+            existing = self.album_art.get(digest)
+        os.makedirs(os.path.dirname(image_dest), exist_ok=True)
+        temp_name = self.get_temp_name(image_dest)
+        try:
+            if not existing or existing == image_dest or \
+                    not link_file(existing, temp_name, self.writer.copy):
+                self.writer.write(temp_name, self.convert_album_art(data))
+            os.replace(temp_name, image_dest)
+            self.writer.written(image_dest, os.path.getsize(image_dest))
+        except OSError:
+            self.remove_temp_file(temp_name)
+            raise
+        self.logger.debug("Copying album art: " + image_dest)
+        self.add_album_art(digest, image_dest)
+        self.metrics.record("art", start_time, os.path.getsize(image_dest),
+                            name=image_dest)
+        return digest
+
+    # Remember the content hash of the album art at path. A path replaced
+    # with other content can't be linked to for its old hash any more.
+    def add_album_art(self, digest, path):
+        with self.lock:
+            old_digest = self.album_art_paths.get(path)
+            if old_digest != digest and \
+                    self.album_art.get(old_digest) == path:
+                del self.album_art[old_digest]
+            self.album_art_paths[path] = digest
+            self.album_art.setdefault(digest, path)
+
+    # Scale the image down to album_art_max_size and re-encode it as JPEG if
+    # configured. Images needing neither are returned unchanged.
+    def convert_album_art(self, data):
+        if not self.album_art_max_size and not self.album_art_jpeg:
+            return data
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = "JPEG" if self.album_art_jpeg else image.format
+            if self.album_art_max_size and \
+                    max(image.size) > self.album_art_max_size:
+                image.thumbnail((self.album_art_max_size,
+                                 self.album_art_max_size))
+            elif image.format == image_format:
+                return data
+            options = {}
+            if image_format == "JPEG":
+                options["quality"] = self.album_art_quality
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, image_format, **options)
+            return output.getvalue()
+
+    # Drop the manifest entries of removed files and the folders whose album
+    # art was removed, so they are synced again if needed.
+    def drop_manifest_entries(self, removed):
+        removed = removed.keys
+        for entry in list(self.manifest.entries.values()):
+            if self.normalize_path(os.path.join(
+                    self.dest_dir, entry.dest)) in removed:
+                self.manifest.remove(entry.src)
+        for folder in list(self.manifest.folders.values()):
+            if any(self.normalize_path(os.path.join(self.dest_dir, path))
+                   in removed for path, _ in folder.outputs):
+                self.manifest.remove_folder(folder.src)
+
+    # Remove files from destination that are not in playlist any more. If
+    # the manifest knows the outputs of the last sync, only these are
+    # compared with the files of this sync, otherwise the destination folder
+    # is scanned.
+    def delete_non_existant(self, added_files):
+        self.logger.info("Start removing files now.")
+        if not os.path.isdir(self.dest_dir):
+            return
+        if not self.dry_run:
+            self.dest_case_insensitive = self.is_case_insensitive(
+                self.dest_dir)
+        keep = {self.normalize_path(path) for path in added_files}
+        removed = RemovedPaths(self.normalize_path)
+        if self.manifest and self.manifest.outputs is not None:
+            self.prune_outputs(self.manifest.outputs, keep, removed)
+        else:
+            self.prune_tree(self.dest_dir, keep, removed)
+        self.logger.info(str(len(removed)) + " files and folders " + (
+            "would be removed." if self.dry_run or self.prune_dry_run else
+            "removed."))
+        if not self.manifest or self.dry_run or self.prune_dry_run:
+            return
+        # Files of removed entries have to be synced again, should they be
+        # added to the playlist again.
+        self.drop_manifest_entries(removed)
+        self.manifest.set_outputs(added_files - self.manifest.files())
+        self.manifest.commit()
+
+    def __init__(self, config_file=None, config=None):
+        get_umask()
+        self.config_file = config_file
+        self.config = config
+        self.config_parser = None
+        self.host = "localhost"
+        self.port = ""
+        self.password = ""
+        self.mpd_root_dir = ""
+        self.dest_dir = ""
+        self.audio_format = "opus"
+        self.threads = 8
+        self.io_threads = 2
+        self.probe_threads = 8
+        # Destination writes, see DestinationWriter. Sizes in KB and MB.
+        self.write_threads = 0
+        self.write_buffer_size = 0
+        self.preallocate = True
+        self.fsync_batch = 64
+        self.writer = None
+        # Local folder the encoders write to during a sync
+        self.staging_dir = None
+        self.ffmpeg = "ffmpeg"
+        self.transcode_timeout = 3600
+        self.transcode_retries = 1
+        self.queue_size = 64
+        self.verbose = False
+        self.will_delete_non_existent = False
+        self.will_copy_album_art = True
+        self.album_art_max_size = 0
+        self.album_art_jpeg = False
+        self.album_art_quality = 90
+        self.transcode_flac = True
+        self.transcode_mp3 = False
+        self.transcode_m4a = False
+        self.transcode_m4a_threshold = 200000
+        self.transcode_mp3_threshold = 200000
+        self.audio_quality_lame = 3
+        self.audio_quality_opus = 96000
+        self.audio_quality_vorbis = 4
+        self.mpd_metadata = False
+        self.use_manifest = True
+        self.fingerprint = ""
+        self.rebuild_manifest = False
+        self.check_manifest = False
+        self.dry_run = False
+        self.prune_dry_run = False
+        # Name of a [Target:*] section, and all targets to sync
+        self.name = ""
+        self.targets = [self]
+        # Encoded files by source and encoder settings, shared by all targets
+        self.encodes = {}
+        # Sources to sync. The queue is synced by default, unless playlists
+        # or find queries are given.
+        self.sync_queue = None
+        self.playlists = []
+        self.find_queries = []
+        self.stored_playlists = {}
+        self.write_m3u = False
+        self.use_transcode_cache = False
+        self.transcode_cache_dir = ""
+        self.transcode_cache_size = 10000
+        self.transcode_cache = None
+        self.ffmpeg_version = None
+        self.watch_debounce = 2
+        self.show_plan = False
+        self.metrics_file = ""
+        self.metrics = SyncMetrics()
+        self.logger = logging.getLogger("mpd-ps")
+        self.mpd_playlist = None
+        self.mpd_songs = {}
+        self.playlist_version = None
+        self.manifest = None
+        self.lock = threading.Lock()
+        self.dest_case_insensitive = False
+        # Path of the first album art written, by content hash, and back
+        self.album_art = {}
+        self.album_art_paths = {}
+        self.album_art_changed = False
+        # Audio info by (path, mtime, size), kept across syncs
+        self.probe_cache = {}
+        # Plan of the running sync. The cancel event and the running encoders
+        # are shared by all targets.
+        self.plan = None
+        self.cancelled = threading.Event()
+        self.encoders = set()
+
+    # Read the options of a section, [General] or a [Target:*] section
+    # overriding them.
+    def read_options(self, config_parser, section):
+        if config_parser.has_option(section, 'src'):
+            self.mpd_root_dir = config_parser.get(section, 'src')
+        if config_parser.has_option(section, 'dest'):
+            self.dest_dir = config_parser.get(section, 'dest')
+        if config_parser.has_option(section, 'audio_format'):
+            self.audio_format = config_parser.get(section,
+                                                  'audio_format')
+        if config_parser.has_option(section, 'transcode_flac'):
+            self.transcode_flac = config_parser.getboolean(section,
+                                                           'transcode_flac')
+        if config_parser.has_option(section, 'threads'):
+            self.threads = config_parser.getint(section, 'threads')
+        if config_parser.has_option(section, 'io_threads'):
+            self.io_threads = config_parser.getint(section,
+                                                   'io_threads')
+        if config_parser.has_option(section, 'write_threads'):
+            self.write_threads = config_parser.getint(section,
+                                                      'write_threads')
+        if config_parser.has_option(section, 'write_buffer_size'):
+            self.write_buffer_size = config_parser.getint(
+                section, 'write_buffer_size')
+        if config_parser.has_option(section, 'preallocate'):
+            self.preallocate = config_parser.getboolean(section,
+                                                        'preallocate')
+        if config_parser.has_option(section, 'fsync_batch'):
+            self.fsync_batch = config_parser.getint(section, 'fsync_batch')
+        if config_parser.has_option(section, 'probe_threads'):
+            self.probe_threads = config_parser.getint(
+                section, 'probe_threads')
+        if config_parser.has_option(section, 'queue_size'):
+            self.queue_size = config_parser.getint(section,
+                                                   'queue_size')
+        if config_parser.has_option(section, 'ffmpeg'):
+            self.ffmpeg = config_parser.get(section, 'ffmpeg')
+        if config_parser.has_option(section, 'transcode_timeout'):
+            self.transcode_timeout = config_parser.getint(
+                section, 'transcode_timeout')
+        if config_parser.has_option(section, 'transcode_retries'):
+            self.transcode_retries = config_parser.getint(
+                section, 'transcode_retries')
+        if config_parser.has_option(section, 'verbose'):
+            self.verbose = config_parser.getboolean(section,
+                                                    'verbose')
+        if config_parser.has_option(section, 'delete_non_existent'):
+            self.will_delete_non_existent = config_parser.getboolean(
+                section,
+                'delete_non_existent')
+        if config_parser.has_option(section, 'mpd_metadata'):
+            self.mpd_metadata = config_parser.getboolean(
+                section, 'mpd_metadata')
+        if config_parser.has_option(section, 'queue'):
+            self.sync_queue = config_parser.getboolean(section, 'queue')
+        if config_parser.has_option(section, 'playlists'):
+            self.playlists = [name.strip() for name in re.split(
+                r"[,\n]", config_parser.get(section, 'playlists'))
+                if name.strip()]
+        if config_parser.has_option(section, 'find'):
+            self.find_queries = [self.parse_query(query) for query in
+                                 config_parser.get(section,
+                                                   'find').splitlines()
+                                 if query.strip()]
+        if config_parser.has_option(section, 'write_m3u'):
+            self.write_m3u = config_parser.getboolean(section, 'write_m3u')
+        if config_parser.has_option(section, 'transcode_cache'):
+            self.use_transcode_cache = config_parser.getboolean(
+                section, 'transcode_cache')
+        if config_parser.has_option(section, 'transcode_cache_dir'):
+            self.transcode_cache_dir = config_parser.get(
+                section, 'transcode_cache_dir')
+        if config_parser.has_option(section, 'transcode_cache_size'):
+            self.transcode_cache_size = config_parser.getint(
+                section, 'transcode_cache_size')
+        if config_parser.has_option(section, 'metrics_file'):
+            self.metrics_file = config_parser.get(section,
+                                                  'metrics_file')
+        if config_parser.has_option(section, 'watch_debounce'):
+            self.watch_debounce = config_parser.getfloat(
+                section, 'watch_debounce')
+        if config_parser.has_option(section, 'manifest'):
+            self.use_manifest = config_parser.getboolean(section,
+                                                         'manifest')
+        if config_parser.has_option(section, 'fingerprint'):
+            self.fingerprint = config_parser.get(section,
+                                                 'fingerprint')
+        if config_parser.has_option(section, 'copy_album_art'):
+            self.will_copy_album_art = config_parser.getboolean(
+                section, 'copy_album_art')
+        if config_parser.has_option(section, 'album_art_max_size'):
+            self.album_art_max_size = config_parser.getint(
+                section, 'album_art_max_size')
+        if config_parser.has_option(section, 'album_art_jpeg'):
+            self.album_art_jpeg = config_parser.getboolean(
+                section, 'album_art_jpeg')
+        if config_parser.has_option(section, 'album_art_quality'):
+            self.album_art_quality = config_parser.getint(
+                section, 'album_art_quality')
+        if config_parser.has_option(section, 'transcode_m4a'):
+            self.transcode_m4a = config_parser.getboolean(section,
+                                                          'transcode_m4a')
+        if config_parser.has_option(section,
+                                    'transcode_m4a_threshold'):
+            self.transcode_m4a_threshold = config_parser.getint(
+                section,
+                'transcode_m4a_threshold')
+        if config_parser.has_option(section, 'transcode_mp3'):
+            self.transcode_mp3 = config_parser.getboolean(section,
+                                                          'transcode_mp3')
+        if config_parser.has_option(section,
+                                    'transcode_mp3_threshold'):
+            self.transcode_mp3_threshold = config_parser.getint(
+                section,
+                'transcode_mp3_threshold')
+        if config_parser.has_option(section,
+                                    'audio_quality_lame'):  # 0 - 10,
+            self.audio_quality_lame = config_parser.getint(section,
+                                                           'audio_quality_lame')
+        if config_parser.has_option(section,
+                                    'audio_quality_vorbis'):  # -1..10, fractions
+            # allowed
+            self.audio_quality_vorbis = config_parser.getfloat(
+                section,
+                'audio_quality_vorbis')
+        if config_parser.has_option(section,
+                                    'audio_quality_opus'):  # in bit/s
+            self.audio_quality_opus = config_parser.getint(section,
+                                                           'audio_quality_opus')
+
+    # Read the config from the dict config, mapping section names to
+    # options, or else from the config file.
+    def read_config(self):
+        config_parser = configparser.RawConfigParser()
+        if self.config is not None:
+            config_parser.read_dict(self.config)
+        else:
+            if not self.config_file:
+                if os.path.exists("mpd-ps.conf"):
+                    self.config_file = os.path.join("mpd-ps.conf")
+                elif platform.system() == "Windows":
+                    self.config_file = os.path.join(os.getenv("APPDATA"),
+                                                    "mpd-ps", "mpd-ps.conf")
+                else:
+                    self.config_file = os.path.join(os.path.expanduser("~"),
+                                                    ".config", "mpd-ps",
+                                                    "mpd-ps.conf")
+            if not os.path.exists(self.config_file):
+                raise ConfigError(
+                    "Config file not found. Config file has to be places in "
+                    "the same folder as this script or in "
+                    "$HOME/.conf/mpd-ps/mpd-ps.conf or to be specified by "
+                    "using the --config [PATH_TO_CONF] switch.")
+            config_parser.read(self.config_file)
+        if config_parser.has_section('Host'):
+            if config_parser.has_option('Host', 'host'):
+                self.host = config_parser.get('Host', 'host')
+            if config_parser.has_option('Host', 'port'):
+                self.port = config_parser.get('Host', 'port')
+            if config_parser.has_option('Host', 'password'):
+                self.password = config_parser.get('Host', 'password')
+        if config_parser.has_section('General'):
+            self.read_options(config_parser, 'General')
+        self.config_parser = config_parser
+
+    # Check the options read by read_config and set up the targets. Raises
+    # ConfigError for invalid options.
+    def check_config(self):
+        if self.config is None:
+            self.logger.info('Using configuration file: ' + self.config_file)
+
+        if not self.mpd_root_dir:
+            raise ConfigError(
+                "Please specify the root folder of mpd server within config "
+                "file (src).")
+
+        if not self.host:
+            self.host = "localhost"
+
+        if not self.port:
+            self.port = 6600
+
+        if not self.password:
+            self.password = ""
+
+        if self.metrics_file:
+            self.metrics.prometheus_file = self.metrics_file
+
+        if self.sync_queue is None:
+            self.sync_queue = not self.playlists and not self.find_queries
+        for query in self.find_queries:
+            if len(query) % 2 and not query[0].startswith("("):
+                raise ConfigError(
+                    "Bad find query: " + " ".join(query) + ". Use pairs of "
+                    "tag and value or a filter expression.")
+
+        self.logger.info('Host: ' + self.host + ":" + str(self.port))
+        self.logger.info('MPD music folder: ' + self.mpd_root_dir)
+
+        # The transcode cache is shared by all targets
+        if self.use_transcode_cache and not self.dry_run:
+            cache_dir = self.transcode_cache_dir or self.get_cache_dir()
+            self.logger.info('Transcode cache: ' + cache_dir + " (" +
+                             str(self.transcode_cache_size) + " MB)")
+            self.transcode_cache = TranscodeCache(
+                cache_dir, self.transcode_cache_size * 1024 * 1024)
+
+        # Each [Target:*] section is synced to a destination of its own,
+        # with the options of [General] as defaults.
+        self.targets = []
+        for section in self.config_parser.sections():
+            if section.startswith("Target:"):
+                target = copy.copy(self)
+                target.name = section[len("Target:"):]
+                target.targets = [target]
+                target.album_art = {}
+                target.album_art_paths = {}
+                target.read_options(self.config_parser, section)
+                self.targets.append(target)
+        if not self.targets:
+            self.targets = [self]
+        for target in self.targets:
+            target.check_target()
+
+    def parse_config_file(self):
+        self.read_config()
+        self.check_config()
+
+    # Check the settings of a destination and log them.
+    def check_target(self):
+        prefix = "Target " + self.name + ": " if self.name else ""
+        if not self.dest_dir:
+            raise ConfigError(
+                prefix + "Please specify the destination folder within "
+                         "config file (dest).")
+        # Paths below it are compared as strings, e.g. when pruning
+        self.dest_dir = os.path.normpath(self.dest_dir)
+
+        if self.audio_format == "":
+            self.audio_format = "opus"
+        elif self.audio_format != "ogg" and self.audio_format != "mp3" and \
+                        self.audio_format != "opus":
+            raise ConfigError(
+                prefix + "Bad audio format. mpd-ps supports ogg, opus and "
+                         "mp3.")
+
+        if self.fingerprint and self.fingerprint not in FINGERPRINTS:
+            raise ConfigError(
+                "Bad fingerprint. mpd-ps supports blake2 and xxhash.")
+        elif self.fingerprint == "xxhash" and not has_module("xxhash"):
+            raise ConfigError(
+                "Fingerprint xxhash requires the python xxhash module.")
+
+        if self.album_art_max_size < 0:
+            self.album_art_max_size = 0
+        if not 1 <= self.album_art_quality <= 95:
+            raise ConfigError(
+                "Bad album art quality. Use a value between 1 and 95.")
+        if (self.album_art_max_size or self.album_art_jpeg) and \
+                not has_module("PIL"):
+            raise ConfigError(
+                "Resizing album art requires the python Pillow module.")
+
+        if not self.transcode_flac:
+            self.logger.warn(
+                prefix + "Copying FLAC files instead of transcoding. "
+                         "Specified audio format settings is ignored.")
+
+        if not self.threads or self.threads <= 0:
+            self.threads = os.cpu_count() or 1
+
+        if not self.io_threads or self.io_threads <= 0:
+            self.io_threads = 2
+
+        if not self.probe_threads or self.probe_threads <= 0:
+            self.probe_threads = 8
+
+        if self.write_threads < 0:
+            self.write_threads = 0
+
+        if self.write_buffer_size < 0:
+            self.write_buffer_size = 0
+
+        if self.fsync_batch < 0:
+            self.fsync_batch = 0
+
+        if self.queue_size < 0:
+            self.queue_size = 0
+
+        self.logger.info(prefix + 'Destination folder: ' + self.dest_dir)
+        self.logger.info(
+            prefix + 'FLAC files:' + 'transcode to ' + self.audio_format if
+            self.transcode_flac else prefix + 'FLAC files: copy')
+        self.logger.info(
+            prefix + 'MP3 files:' + 'transcode to ' + self.audio_format +
+            ' if bitrate > ' + str(self.transcode_mp3_threshold / 1000) +
+            'kbit/s' if self.transcode_mp3 else prefix + 'MP3 files: copy')
+        self.logger.info(
+            prefix + 'M4A files:' + 'transcode to ' + self.audio_format +
+            ' if bitrate > ' + str(self.transcode_m4a_threshold / 1000) +
+            'kbit/s' if self.transcode_m4a else prefix + 'M4A files: copy')
+        self.logger.info(prefix + 'Transcoder threads: ' + str(self.threads))
+        self.logger.info(prefix + 'I/O threads: ' + str(self.io_threads))
+        if self.write_threads:
+            self.logger.info(prefix + 'Write threads: ' +
+                             str(self.write_threads))
+        self.logger.info(prefix + 'Probe threads: ' +
+                         str(self.probe_threads))
+
+    # Settings which influence the decision taken for a file. Manifest entries
+    # recorded with other settings are discarded.
+    def get_manifest_settings(self):
+        return ",".join(str(setting) for setting in (
+            self.audio_format, self.transcode_flac, self.transcode_mp3,
+            self.transcode_m4a, self.transcode_mp3_threshold,
+            self.transcode_m4a_threshold, self.audio_quality_lame,
+            self.audio_quality_opus, self.audio_quality_vorbis))
+
+    # A read only manifest, as for dry runs, leaves the destination
+    # untouched.
+    def open_manifest(self, read_only=False):
+        read_only = read_only or self.dry_run
+        if not os.path.exists(self.dest_dir) and not read_only:
+            os.makedirs(self.dest_dir)
+        self.manifest = SyncManifest(self.dest_dir,
+                                     self.get_manifest_settings(),
+                                     self.mpd_root_dir, self.fingerprint,
+                                     read_only)
+        # Both scan the destination for files to remove
+        if self.rebuild_manifest:
+            self.logger.info("Rebuilding manifest.")
+            self.manifest.clear()
+            self.manifest.outputs = None
+        elif self.check_manifest:
+            self.manifest.check()
+            self.manifest.outputs = None
+        # Album art is written again if its settings changed
+        album_art_settings = ",".join(str(setting) for setting in (
+            self.album_art_max_size, self.album_art_jpeg,
+            self.album_art_quality))
+        self.album_art_changed = "album_art" in self.manifest.meta and \
+            self.manifest.get_meta("album_art") != album_art_settings
+        if self.manifest.get_meta("album_art") != album_art_settings:
+            self.manifest.clear_folders()
+            self.manifest.set_meta("album_art", album_art_settings)
+        for folder in self.manifest.folders.values():
+            for path, digest in folder.outputs:
+                self.add_album_art(digest, os.path.join(self.dest_dir, path))
+        self.logger.info("Manifest contains " + str(
+            len(self.manifest.entries)) + " files.")
+
+    def connect_mpd(self):
+        import mpd
+        client = mpd.MPDClient()
+        client.timeout = 10
+        client.idletimeout = None  # timeout for fetching the result of the idle
+        # command is handled separately, default: None
+        client.connect(self.host, self.port)  # connect to localhost:6600
+        client.password(self.password)
+        return client
+
+    def get_mpd_playlist(self):
+        client = self.connect_mpd()
+        self.fetch_playlist(client)
+        client.close()  # send the close command
+        client.disconnect()  # disconnect from the server
+
+    # Fetch the files to sync: the queue and/or the songs of the stored
+    # playlists and find queries. Songs found in several of them are synced
+    # once.
+    def fetch_playlist(self, client):
+        start_time = time.monotonic()
+        self.playlist_version = int(client.status()["playlist"])
+        self.mpd_songs = {}
+        playlist = []
+        if self.sync_queue and self.mpd_metadata:
+            songs = self.get_playlist_info(client)
+            self.mpd_songs = {song["file"]: song for song in songs}
+            playlist = [song["file"] for song in songs]
+        elif self.sync_queue:
+            playlist = [item[6:] for item in client.playlist()]
+        self.stored_playlists = {}
+        if self.playlists or self.find_queries:
+            sources = self.fetch_sources(client)
+            for name, songs in zip(self.playlists, sources):
+                if songs is not None:
+                    self.stored_playlists[name] = [song["file"]
+                                                   for song in songs]
+            for songs in filter(None, sources):
+                playlist += [song["file"] for song in songs]
+                if self.mpd_metadata:
+                    self.mpd_songs.update((song["file"], song)
+                                          for song in songs)
+            # Streams can't be synced
+            playlist = [item for item in dict.fromkeys(playlist)
+                        if "://" not in item]
+            self.logger.info("Found " + str(len(playlist)) + " files in " +
+                             str(len(list(filter(None, sources)))) +
+                             " playlists and queries.")
+        self.mpd_playlist = playlist
+        self.metrics.record("playlist", start_time)
+
+    # Fetch the songs of the stored playlists and of the find queries, in
+    # this order, with one command list. If MPD rejects one of them, e.g. a
+    # playlist which doesn't exist, they are fetched one by one and the
+    # failing ones are returned as None.
+    def fetch_sources(self, client):
+        import mpd
+        commands = [(client.listplaylistinfo, [name])
+                    for name in self.playlists]
+        commands += [(client.find, query) for query in self.find_queries]
+        try:
+            client.command_list_ok_begin()
+            for command, args in commands:
+                command(*args)
+            return client.command_list_end()
+        except mpd.CommandError:
+            pass
+        sources = []
+        for command, args in commands:
+            try:
+                sources.append(command(*args))
+            except mpd.CommandError as e:
+                self.logger.error("Can't fetch " + " ".join(args) + ": " +
+                                  str(e))
+                sources.append(None)
+        return sources
+
+    # Write a .m3u file for each stored playlist into the destination,
+    # listing the synced files of its songs. Unchanged files are not written
+    # again.
+    def write_playlist_files(self, added_files, dest_names):
+        for name, files in self.stored_playlists.items():
+            path = os.path.join(self.dest_dir,
+                                name.replace("/", "_") + ".m3u")
+            added_files.add(path)
+            content = "#EXTM3U\n" + "".join(
+                os.path.relpath(dest_names[file], self.dest_dir).replace(
+                    os.sep, "/") + "\n" for file in files
+                if file in dest_names)
+            if self.dry_run:
+                continue
+            try:
+                with open(path, encoding="utf-8") as file:
+                    if file.read() == content:
+                        continue
+            except OSError:
+                pass
+            self.logger.debug("Writing playlist " + path)
+            temp_name = self.get_temp_name(path)
+            self.writer.write(temp_name, content.encode("utf-8"))
+            os.replace(temp_name, path)
+            self.writer.written(path, len(content))
+
+    # A find query is either a filter expression in parentheses or pairs of
+    # tag and value, e.g. artist "Pink Floyd" album Animals.
+    @staticmethod
+    def parse_query(query):
+        query = query.strip()
+        if query.startswith("("):
+            return [query]
+        return shlex.split(query)
+
+    # Apply the changes since the last known playlist version to the
+    # playlist. Returns the files added to and removed from the playlist.
+    def update_playlist(self, client):
+        start_time = time.monotonic()
+        status = client.status()
+        length = int(status["playlistlength"])
+        changes = client.plchanges(self.playlist_version)
+        playlist = self.mpd_playlist[:length]
+        playlist += [None] * (length - len(playlist))
+        for song in changes:
+            playlist[int(song["pos"])] = song["file"]
+            if self.mpd_metadata:
+                self.mpd_songs[song["file"]] = song
+        old_files = set(self.mpd_playlist)
+        new_files = set(playlist)
+        self.mpd_playlist = playlist
+        self.playlist_version = int(status["playlist"])
+        self.metrics.record("playlist", start_time)
+        return [item for item in playlist if item not in old_files], \
+            old_files - new_files
+
+    # Remove the files of songs removed from the playlist from the
+    # destination, using the destination paths recorded in the manifest.
+    def remove_synced_files(self, names):
+        folders = set()
+        removed = RemovedPaths(self.normalize_path)
+        for name in names:
+            entry = self.manifest.entries.get(name)
+            if not entry:
+                continue
+            dest = os.path.join(self.dest_dir, entry.dest)
+            self.prune(dest, removed)
+            self.manifest.remove(name)
+            folders.add(os.path.dirname(dest))
+        for folder in folders:
+            self.remove_empty_parents(folder, removed, orphaned_art=True)
+        self.drop_manifest_entries(removed)
+        self.manifest.remove_outputs(removed)
+        self.manifest.commit()
+
+    # Keep syncing the playlist as MPD reports changes. After a change, wait
+    # watch_debounce seconds to collect further changes, then sync only the
+    # added and removed songs. Changes of the music database trigger a full
+    # sync, as files may have changed.
+    def watch(self):
+        client = self.connect_mpd()
+        self.fetch_playlist(client)
+        self.sync()
+        try:
+            self.watch_playlist(client)
+        except KeyboardInterrupt:
+            self.logger.info("Stopped watching MPD.")
+
+    def watch_playlist(self, client):
+        import mpd
+        subsystems = ["database"]
+        if self.sync_queue:
+            subsystems.append("playlist")
+        if self.playlists:
+            subsystems.append("stored_playlist")
+        while True:
+            try:
+                if client is None:
+                    # Catch up with the changes made while disconnected
+                    client = self.connect_mpd()
+                    changes = []
+                else:
+                    changes = client.idle(*subsystems)
+                    self.logger.info("MPD reported changes: " +
+                                     ", ".join(changes))
+                    time.sleep(self.watch_debounce)
+                # Changes of stored playlists and query results can't be
+                # tracked like the queue, so they are fetched again
+                if self.playlists or self.find_queries or changes and (
+                        "database" in changes or not all(
+                            target.manifest for target in self.targets)):
+                    self.fetch_playlist(client)
+                    self.sync()
+                    continue
+                added, removed = self.update_playlist(client)
+            except (mpd.ConnectionError, OSError) as e:
+                # MPD drops clients which are busy syncing for too long
+                self.logger.info("Lost connection to MPD (" + str(e) +
+                                 "). Reconnecting.")
+                client = None
+                time.sleep(self.watch_debounce)
+                continue
+            self.logger.info(str(len(added)) + " files added to and " +
+                             str(len(removed)) + " files removed from "
+                             "playlist.")
+            for target in self.targets:
+                if removed and target.will_delete_non_existent:
+                    target.remove_synced_files(removed)
+            if added:
+                self.sync(added)
+            else:
+                self.metrics.finish(True)
+
+    # Fetch the metadata of all songs in the playlist. The playlist is
+    # requested in ranges, which are sent as one command list, so large
+    # playlists don't exceed the output buffer of MPD.
+    def get_playlist_info(self, client):
+        length = int(client.status()["playlistlength"])
+        if not length:
+            return []
+        client.command_list_ok_begin()
+        for start in range(0, length, self.PLAYLIST_INFO_BATCH):
+            client.playlistinfo(str(start) + ":" +
+                                str(start + self.PLAYLIST_INFO_BATCH))
+        return [song for songs in client.command_list_end()
+                for song in songs]
+
+    # Check with the song metadata of MPD whether a file is unchanged since
+    # its manifest entry was recorded. MPD reports modification times in
+    # seconds only.
+    @staticmethod
+    def is_unchanged_in_mpd(entry, song):
+        try:
+            modified = calendar.timegm(time.strptime(
+                song["last-modified"], "%Y-%m-%dT%H:%M:%SZ"))
+        except (KeyError, ValueError):
+            return False
+        if entry.mtime // 1000000000 != modified:
+            return False
+        length = MpdPs.get_song_length(song)
+        return entry.length is None or length is None or \
+            abs(entry.length - length) < 1
+
+    @staticmethod
+    def get_song_length(song):
+        length = song.get("duration", song.get("time"))
+        return float(length) if length is not None else None
+
+    # Files whose headers have to be parsed to decide what to do with them.
+    def needs_probing(self, src):
+        return src.endswith(".flac") and self.transcode_flac or \
+            src.endswith(".mp3") and self.transcode_mp3 or \
+            src.endswith(".m4a") and self.transcode_m4a
+
+    # Probe worker: stat a playlist item, look it up in the manifest and
+    # read its audio header if needed. Returns None for missing files.
+    def probe_file(self, src_relative_name):
+        start_time = time.monotonic()
+        try:
+            src = os.path.join(self.mpd_root_dir, src_relative_name)
+            # Files known to MPD are only accessed if MPD reports a change.
+            song = self.mpd_songs.get(src_relative_name)
+            if song and self.manifest:
+                entry = self.manifest.entries.get(src_relative_name)
+                if entry and self.is_unchanged_in_mpd(entry, song):
+                    return self.Probe(src_relative_name, None, entry,
+                                      AudioInfo(None, None, None))
+            try:
+                src_stat = os.stat(src)
+                entry = self.manifest.lookup(src_relative_name, src_stat) \
+                    if self.manifest else None
+            except OSError:
+                return None
+            info = AudioInfo(None, None, None)
+            if not entry and song and src.endswith(".flac"):
+                # No need to parse FLAC files, only their duration is needed
+                info = AudioInfo(None, self.get_song_length(song), "flac")
+            elif not entry and self.needs_probing(src):
+                key = (src, src_stat.st_mtime_ns, src_stat.st_size)
+                info = self.probe_cache.get(key)
+                if info is None:
+                    info = read_audio_info(src)
+                    self.probe_cache[key] = info
+            return self.Probe(src_relative_name, src_stat, entry, info)
+        finally:
+            self.metrics.record("probe", start_time)
+
+    # Probe the playlist items with probe_threads workers. Results are
+    # yielded in playlist order while the workers read ahead.
+    def probe_files(self, items):
+        with concurrent.futures.ThreadPoolExecutor(
+                self.probe_threads,
+                thread_name_prefix="mpd-ps-probe") as executor:
+            pending = collections.deque()
+            for item in items:
+                pending.append(executor.submit(self.probe_file, item))
+                if len(pending) >= 4 * self.probe_threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    # Simulate the transcoding workers, assigning each job to the worker
+    # which becomes idle first. Returns the predicted time until the last
+    # job is finished.
+    def get_makespan(self, jobs, rate):
+        workers = [0.0] * self.threads
+        for job in jobs:
+            heapq.heapreplace(workers, workers[0] + job.cost * rate)
+        return max(workers)
+
+    @staticmethod
+    def format_duration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+    # Report what a sync would do, used by --dry-run.
+    def log_plan(self):
+        if self.name:
+            self.logger.info("Target " + self.name + ":")
+        self.logger.info("Files to copy: " + str(len(self.planned_copies)) +
+                         " (" + str(round(sum(self.planned_copies) /
+                                          (1024 * 1024), 2)) + " MB)")
+        self.logger.info("Files to transcode: " + str(len(
+            self.planned_jobs)) + " (" + self.format_duration(sum(
+                job.length for job in self.planned_jobs)) + " of audio)")
+        if not self.show_plan or not self.planned_jobs:
+            return
+        rate = self.get_encode_rate()
+        jobs = sorted(self.planned_jobs, key=lambda job: job.cost,
+                      reverse=True)
+        for job in jobs:
+            self.logger.info("  " + self.format_duration(job.cost * rate) +
+                             "  " + job.name)
+        self.logger.info("Predicted transcoding time with " +
+                         str(self.threads) + " workers: " +
+                         self.format_duration(self.get_makespan(jobs, rate)) +
+                         " (longest first), " + self.format_duration(
+                             self.get_makespan(self.planned_jobs, rate)) +
+                         " (playlist order)")
+
+    # Sync items, the whole playlist by default, to all targets, or run the
+    # remaining actions of plan. The targets are synced one after another;
+    # they share the probed file information and files already encoded with
+    # the same settings for another target. Only a sync of the whole playlist
+    # removes other files from the destination.
+    def sync(self, items=None, plan=None):
+        success = True
+        for target in self.targets:
+            if self.cancelled.is_set():
+                break
+            if target.name:
+                self.logger.info("Syncing target " + target.name + ".")
+            self.share_playlist(target)
+            target_plan = plan.get(target) if plan else None
+            success = target.sync_plalist(items, target_plan) and success
+        self.metrics.finish(success and not self.cancelled.is_set())
+        return success
+
+    # Plan a sync of items, the whole playlist by default, to all targets
+    # without changing them.
+    def plan_sync(self, items=None):
+        plans = []
+        for target in self.targets:
+            self.share_playlist(target)
+            plan = target.create_plan(items)
+            for _ in target.plan_items(plan, count=False):
+                pass
+            plans.append(plan)
+        return SyncPlan(plans)
+
+    def share_playlist(self, target):
+        target.mpd_playlist = self.mpd_playlist
+        target.mpd_songs = self.mpd_songs
+        target.stored_playlists = self.stored_playlists
+
+    def create_plan(self, items=None):
+        if items is None:
+            return TargetPlan(self, self.mpd_playlist, True)
+        return TargetPlan(self, items, False)
+
+    # Stop a running sync: no further files are queued, queued jobs are
+    # dropped and running encoders are killed. Finished files are recorded
+    # in the manifest, so the next sync continues where this one stopped.
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            processes = list(self.encoders)
+        for process in processes:
+            self.kill_encoder(process)
+
+    # Walk the items of plan and yield the actions needed to sync them, adding
+    # them to the plan. Files synced before are only added to its outputs.
+    def plan_items(self, plan, count=True):
+        item_size = 0
+        for probe in self.probe_files(plan.items):
+            if item_size % 10 == 0:
+                self.logger.info("Processed " + str(item_size) + "/" + str(
+                    len(plan.items)) + " files (" + str(
+                    int(100 * item_size / len(plan.items))) + "%).")
+            if count:
+                self.metrics.walk()
+            if probe is None:
+                continue
+            src_relative_name = probe.name
+            src_stat = probe.stat
+            src_absolute_name = os.path.join(self.mpd_root_dir,
+                                             src_relative_name)
+            src_absolute_path = os.path.dirname(src_absolute_name)
+
+            dest_absolute_name = os.path.join(self.dest_dir,
+                                              src_relative_name)
+            dest_absolute_path = os.path.dirname(dest_absolute_name)
+
+            # Skip files, which did not change since the last sync
+            if probe.entry:
+                dest_absolute_name = os.path.join(self.dest_dir,
+                                                  probe.entry.dest)
+                yield from self.add_folder(plan, src_absolute_path,
+                                           os.path.dirname(dest_absolute_name))
+                plan.added_files.add(dest_absolute_name)
+                plan.dest_names[src_relative_name] = dest_absolute_name
+                item_size += 1
+                continue
+
+            transcode_file = False
+            bitrate = probe.info.bitrate
+            length = probe.info.length
+            if src_absolute_name.endswith(".flac") and self.transcode_flac:
+                transcode_file = True
+                dest_absolute_name = re.sub(r".m4a$", "." + self.audio_format,
+                                            dest_absolute_name)
+                dest_absolute_name = re.sub(r".flac$", "." + self.audio_format,
+                                            dest_absolute_name)
+
+            if src_absolute_name.endswith(".mp3") and self.transcode_mp3:
+                if bitrate is None:
+                    self.logger.warning("Can't read bitrate of " +
+                                        src_absolute_name + ". Copying it.")
+                elif bitrate >= self.transcode_mp3_threshold:
+                    transcode_file = True
+                    dest_absolute_name = re.sub(r".mp3$",
+                                                "." + self.audio_format,
+                                                dest_absolute_name)
+
+            if src_absolute_name.endswith(".m4a") and self.transcode_m4a:
+                if bitrate is None:
+                    self.logger.warning("Can't read bitrate of " +
+                                        src_absolute_name + ". Copying it.")
+                elif bitrate >= self.transcode_m4a_threshold:
+                    transcode_file = True
+                    dest_absolute_name = re.sub(r".m4a$",
+                                                "." + self.audio_format,
+                                                dest_absolute_name)
+
+            item_size += 1
+            plan.dest_names[src_relative_name] = dest_absolute_name
+            action = "transcode" if transcode_file else "copy"
+            yield from self.add_folder(plan, src_absolute_path,
+                                       dest_absolute_path)
+            # Skip existing files
+            if self.is_up_to_date(src_absolute_name, src_stat,
+                                  dest_absolute_name, transcode_file, length):
+                self.logger.debug(
+                    "file " + dest_absolute_name + " exists. Skipping.")
+                plan.added_files.add(dest_absolute_name)
+                if self.manifest:
+                    plan.records.append((src_relative_name, src_stat, action,
+                                         bitrate, dest_absolute_name, length))
+                continue
+
+            if dest_absolute_name in plan.added_files:
+                self.logger.debug("Duplicate playlist item ignored: %s",
+                                  dest_absolute_name)
+                continue
+            plan.added_files.add(dest_absolute_name)
+            action = SyncAction(action, src_relative_name, src_absolute_name,
+                                dest_absolute_name, src_stat, bitrate, length,
+                                probe.info.codec)
+            plan.actions.append(action)
+            yield action
+
+        self.logger.info("Processed all " + str(item_size) + " files.")
+
+    # Record the files plan found up to date in the manifest.
+    def record_up_to_date(self, plan):
+        if self.manifest and not self.manifest.read_only:
+            for record in plan.records:
+                self.manifest.record(*record)
+            plan.records = []
+
+    # Execute an action: queue a copy or transcoding job, or the copy of the
+    # album art of a folder. In dry runs, only their number and size is
+    # counted.
+    def run_action(self, plan, action):
+        if action.kind == "art":
+            if self.dry_run:
+                plan.added_files.update(os.path.join(
+                    action.dest, self.get_album_art_name(file)) for file in
+                    os.listdir(action.src) if self.is_album_art(file))
+            else:
+                self.io_pool.submit(self.copy_album_art, plan.added_files,
+                                    action.src, action.dest)
+            return
+
+        # Create directories on destination, if they don't exist
+        dest_path = os.path.dirname(action.dest)
+        if not os.path.exists(dest_path) and not self.dry_run:
+            os.makedirs(dest_path, exist_ok=True)
+
+        # Add file to transcode jobs if specified
+        if action.kind == "transcode":
+            job = self.create_transcoding_job(
+                action.src, action.dest, action.name, action.src_stat,
+                action.bitrate, action.length, action.codec)
+            if self.dry_run:
+                self.planned_jobs.append(job)
+                return
+            with self.lock:
+                self.transcode_jobs_size += 1
+            self.metrics.queue(cost=job.cost)
+            self.transcode_queue.put(job)
+
+        # Copy all other audio files directly to destination
+        else:
+            if self.dry_run:
+                self.planned_copies.append(action.src_stat.st_size)
+                return
+            self.metrics.queue(size=action.src_stat.st_size)
+            self.io_pool.submit(self.copy_file, action.name, action.src_stat,
+                                action.bitrate, action.length, action.src,
+                                action.dest)
+
+    # Sync items, the whole playlist by default, to this target, or run the
+    # remaining actions of plan. Without a plan, actions are executed while
+    # the playlist walk is still planning further ones.
+    def sync_plalist(self, items=None, plan=None):
+        if plan is None:
+            plan = self.create_plan(items)
+            actions = self.plan_items(plan)
+        else:
+            actions = plan.remaining()
+        self.plan = plan
+        self.transcoded_files = 0
+        self.transcode_jobs_size = 0
+        self.failed_jobs = []
+        self.encode_time = 0
+        self.encoded_cost = 0
+        self.planned_copies = []
+        self.planned_jobs = []
+        # The playlist walk feeds both pools, so copying and transcoding run
+        # at the same time.
+        self.io_pool = WorkerPool("mpd-ps-io", self.io_threads,
+                                  self.queue_size)
+        self.writer = DestinationWriter(
+            self.dest_dir, self.write_threads, self.write_buffer_size * 1024,
+            self.preallocate, self.fsync_batch * 1024 * 1024)
+        if not self.dry_run:
+            self.staging_dir = tempfile.mkdtemp(prefix="mpd-ps-")
+        self.transcode_queue = JobQueue()
+        self.transcode_pool = WorkerPool("mpd-ps-transcode", self.threads, 0)
+        for _ in range(self.threads):
+            self.transcode_pool.submit(self.transcode_worker)
+        self.metrics.begin_sync(len(plan.items), {
+            "io": self.io_pool, "transcode": self.transcode_queue})
+        if isinstance(actions, list):
+            self.metrics.walk(len(plan.items))
+
+        # Start the sync. On Ctrl-C, the workers are stopped before the
+        # interrupt is passed on, so nothing uses the manifest after it was
+        # closed.
+        try:
+            for action in actions:
+                if self.cancelled.is_set():
+                    break
+                self.run_action(plan, action)
+            self.logger.info("Waiting for copy and transcoding jobs.")
+            self.transcode_queue.close()
+            self.io_pool.shutdown()
+            self.transcode_pool.shutdown()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        finally:
+            self.transcode_queue.close()
+            self.io_pool.shutdown()
+            self.transcode_pool.shutdown()
+            self.writer.flush()
+            if self.staging_dir:
+                shutil.rmtree(self.staging_dir, ignore_errors=True)
+                self.staging_dir = None
+            self.record_up_to_date(plan)
+        cancelled = self.cancelled.is_set()
+        if self.write_m3u and plan.full and not cancelled:
+            for job in self.failed_jobs:
+                plan.dest_names.pop(job.name, None)
+            self.write_playlist_files(plan.added_files, plan.dest_names)
+        if self.dry_run:
+            self.log_plan()
+            if self.will_delete_non_existent and plan.full:
+                if self.manifest:
+                    plan.added_files.update(self.manifest.files())
+                self.delete_non_existant(plan.added_files)
+            return True
+        if self.transcode_jobs_size:
+            self.logger.info("Encoded " + str(self.transcoded_files) +
+                             " files, " + str(len(self.failed_jobs)) +
+                             " failed.")
+        for job in self.failed_jobs:
+            self.logger.error("Failed: " + job.src + " (" +
+                              self.get_job_status(job) + ", " +
+                              str(job.attempts) + " attempts)")
+        # The manifest only lists files stored on the device
+        self.writer.flush()
+
+        added_files = set(plan.added_files)
+        if self.manifest:
+            # Remember the measured encoding speed for the next estimate
+            if self.encoded_cost:
+                self.manifest.set_meta("encode_rate:" + self.audio_format,
+                                       str(self.encode_time /
+                                           self.encoded_cost))
+            self.manifest.add_outputs(added_files)
+            added_files.update(self.manifest.files())
+            self.manifest.commit()
+        if cancelled:
+            self.logger.info("Sync cancelled.")
+            return False
+        if self.will_delete_non_existent and plan.full:
+            self.delete_non_existant(added_files)
+        return not self.failed_jobs
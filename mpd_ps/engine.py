@@ -0,0 +1,95 @@
+from mpd_ps.core import MpdPs, SyncCancelled
+
+
+# Interface for embedding mpd-ps in other programs. The config is a dict of
+# sections like those of the config file, or the path of a config file:
+#
+#     engine = SyncEngine({"Host": {"host": "localhost"},
+#                          "General": {"src": "/srv/music",
+#                                      "dest": "/mnt/sdcard"}})
+#     with engine:
+#         plan = engine.plan()
+#         print(plan.summary())
+#         engine.run(plan)
+#
+# plan() fetches the playlist from MPD and checks which files have to be
+# copied and transcoded. It only reads the manifests, so the destination is
+# not changed until the plan runs. run() executes
+# the plan and can be stopped from another thread with cancel(); running the
+# same plan again continues with the files not synced yet. callback is
+# called with a dict for every synced file, periodically with the progress
+# and with a summary at the end. ConfigError is raised for invalid options.
+# Engines don't share state, so several can sync at the same time. Log
+# messages go to the "mpd-ps" logger, which is left to the caller to
+# configure.
+class SyncEngine:
+    def __init__(self, config=None, config_file=None, callback=None,
+                 dry_run=False, rebuild_manifest=False, check_manifest=False):
+        self.mpd_ps = MpdPs(config_file, config)
+        self.mpd_ps.dry_run = dry_run
+        self.mpd_ps.rebuild_manifest = rebuild_manifest
+        self.mpd_ps.check_manifest = check_manifest
+        self.mpd_ps.parse_config_file()
+        if callback:
+            self.mpd_ps.metrics.callbacks.append(callback)
+        self.opened = False
+        self.read_only = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Open the manifests of the targets, done by plan() and run() if needed.
+    # Read only manifests don't create or change anything in the
+    # destination.
+    def open(self, read_only=False):
+        if self.opened and self.read_only == read_only:
+            return
+        self.close_manifests()
+        for target in self.mpd_ps.targets:
+            if target.use_manifest:
+                target.open_manifest(read_only)
+        self.opened = True
+        self.read_only = read_only
+
+    def close_manifests(self):
+        for target in self.mpd_ps.targets:
+            if target.manifest:
+                target.manifest.close()
+                target.manifest = None
+        self.opened = False
+
+    def close(self):
+        self.close_manifests()
+        if self.mpd_ps.transcode_cache:
+            self.mpd_ps.transcode_cache.close()
+            self.mpd_ps.transcode_cache = None
+
+    # Plan a sync of the playlist, as fetched from MPD now, to all targets.
+    # With items, a list of files relative to the music folder, only these
+    # are synced and no other files are removed from the destination.
+    def plan(self, items=None):
+        self.open(read_only=True)
+        if items is None:
+            self.mpd_ps.get_mpd_playlist()
+        elif self.mpd_ps.mpd_playlist is None:
+            self.mpd_ps.mpd_playlist = []
+        return self.mpd_ps.plan_sync(items and list(items))
+
+    # Run plan, or plan and run a sync of the playlist. Returns whether all
+    # files were synced, raises SyncCancelled if cancel() was called.
+    def run(self, plan=None):
+        if plan is None:
+            plan = self.plan()
+        self.open()
+        self.mpd_ps.cancelled.clear()
+        success = self.mpd_ps.sync(plan=plan)
+        if self.mpd_ps.cancelled.is_set():
+            raise SyncCancelled()
+        return success
+
+    # Stop a running sync as soon as possible. Finished files are kept.
+    def cancel(self):
+        self.mpd_ps.cancel()
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+
+from mpd_ps.core import MpdPs, RemovedPaths, SyncManifest
+
+
+class PruneTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, "src")
+        self.dest = os.path.join(self.dir.name, "dest")
+        os.makedirs(self.src)
+        os.makedirs(self.dest)
+        self.mpd_ps = None
+
+    def tearDown(self):
+        if self.mpd_ps and self.mpd_ps.manifest:
+            self.mpd_ps.manifest.close()
+        self.dir.cleanup()
+
+    def create_mpd_ps(self, dest=None, manifest=True):
+        self.mpd_ps = MpdPs(config={"General": {
+            "src": self.src, "dest": dest or self.dest,
+            "delete_non_existent": "True", "manifest": str(manifest)}})
+        self.mpd_ps.parse_config_file()
+        if manifest:
+            self.mpd_ps.open_manifest()
+        return self.mpd_ps
+
+    def create_files(self, *names):
+        paths = set()
+        for name in names:
+            path = os.path.join(self.dest, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(b"data")
+            paths.add(path)
+        return paths
+
+    # Files and folders below dest, relative to it
+    def list_dest(self):
+        paths = set()
+        for folder, folders, files in os.walk(self.dest):
+            for name in folders + files:
+                paths.add(os.path.relpath(os.path.join(folder, name),
+                                          self.dest))
+        return paths - {SyncManifest.FILE_NAME}
+
+    # Sync outputs to dest with a manifest, then prune all but keep.
+    def prune_outputs(self, outputs, keep, dest=None, dry_run=False):
+        mpd_ps = self.create_mpd_ps(dest)
+        mpd_ps.manifest.set_outputs(self.create_files(*outputs))
+        mpd_ps.manifest.commit()
+        mpd_ps.prune_dry_run = dry_run
+        mpd_ps.delete_non_existant({os.path.join(self.dest, name)
+                                    for name in keep})
+
+    def test_prune_outputs(self):
+        self.create_files("Other/own.mp3")
+        self.prune_outputs(["A/B/1.opus", "A/B/2.opus", "A/C/3.opus"],
+                           ["A/C/3.opus"])
+        self.assertEqual(self.list_dest(), {"A", "A/C", "A/C/3.opus",
+                                            "Other", "Other/own.mp3"})
+
+    def test_prune_nested_empty_folders(self):
+        self.prune_outputs(["A/B/C/1.opus", "D/2.opus"], ["D/2.opus"])
+        self.assertEqual(self.list_dest(), {"D", "D/2.opus"})
+
+    def test_prune_dest_with_trailing_slash(self):
+        self.prune_outputs(["A/B/C/1.opus", "D/2.opus"], ["D/2.opus"],
+                           dest=self.dest + os.sep)
+        self.assertEqual(self.list_dest(), {"D", "D/2.opus"})
+
+    def test_prune_leftover_temp_files(self):
+        self.create_files("A/" + MpdPs.TEMP_PREFIX + "1.opus")
+        self.prune_outputs(["A/1.opus", "D/2.opus"], ["D/2.opus"])
+        self.assertEqual(self.list_dest(), {"D", "D/2.opus"})
+
+    def test_prune_dry_run(self):
+        self.create_files("A/" + MpdPs.TEMP_PREFIX + "1.opus")
+        self.prune_outputs(["A/1.opus", "A/B/2.opus", "D/3.opus"],
+                           ["D/3.opus"], dry_run=True)
+        self.assertEqual(self.list_dest(), {
+            "A", "A/" + MpdPs.TEMP_PREFIX + "1.opus", "A/1.opus", "A/B",
+            "A/B/2.opus", "D", "D/3.opus"})
+
+    def test_prune_tree(self):
+        keep = self.create_files("A/1.opus", "B/C/2.opus")
+        self.create_files("A/3.opus", "D/E/4.opus", "B/5.mp3")
+        os.makedirs(os.path.join(self.dest, "F/G"))
+        self.create_mpd_ps(manifest=False).delete_non_existant(keep)
+        self.assertEqual(self.list_dest(), {"A", "A/1.opus", "B", "B/C",
+                                            "B/C/2.opus"})
+
+    # FAT and exFAT don't distinguish names differing in case
+    def test_prune_tree_case_insensitive(self):
+        self.create_files("Artist/Song.opus", "Artist/Other.opus")
+        mpd_ps = self.create_mpd_ps(manifest=False)
+        mpd_ps.dest_case_insensitive = True
+        keep = {mpd_ps.normalize_path(os.path.join(self.dest,
+                                                   "ARTIST/song.opus"))}
+        removed = RemovedPaths(mpd_ps.normalize_path)
+        mpd_ps.prune_tree(self.dest, keep, removed)
+        self.assertEqual(self.list_dest(), {"Artist", "Artist/Song.opus"})
+        self.assertIn(os.path.join(self.dest, "ARTIST/other.OPUS"), removed)
+
+
+class RemovedPathsTest(unittest.TestCase):
+    def test_membership_is_normalized(self):
+        removed = RemovedPaths(lambda path: os.path.normpath(path).lower())
+        removed.append("/dest/A/1.opus")
+        removed.append("/dest/A")
+        self.assertEqual(removed, ["/dest/A/1.opus", "/dest/A"])
+        self.assertIn("/dest//a/1.OPUS", removed)
+        self.assertNotIn("/dest/A/2.opus", removed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import errno
+import threading
+import unittest
+from unittest import mock
+
+from mpd_ps.core import DestinationWriter, TranscodeCache
+
+
+class TranscodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = TranscodeCache(os.path.join(self.dir.name, "cache"),
+                                    1024 * 1024)
+        self.key = TranscodeCache.get_key("blake2:0123", "opus", "128k")
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+
+    def test_temp_names_are_unique(self):
+        names = {self.cache.get_temp_name(self.key, "opus") for _ in range(5)}
+        self.assertEqual(len(names), 5)
+
+    # Temp files end up in the destination, readable like other files
+    def test_temp_file_permissions(self):
+        umask = os.umask(0o022)
+        try:
+            temp_name = self.cache.get_temp_name(self.key, "opus")
+        finally:
+            os.umask(umask)
+        if os.name == "posix":
+            self.assertEqual(os.stat(temp_name).st_mode & 0o777, 0o644)
+
+    # Writers storing the same key at the same time (identical sources, or
+    # processes sharing the cache) must not fail each other.
+    def test_concurrent_stores_of_one_key(self):
+        errors = []
+        results = []
+
+        def store(n):
+            try:
+                temp_name = self.cache.get_temp_name(self.key, "opus")
+                with open(temp_name, "wb") as file:
+                    file.write(b"encoded")
+                self.cache.store(self.key, "opus", temp_name)
+                dest = os.path.join(self.dir.name, str(n) + ".opus")
+                results.append(self.cache.fetch(self.key, "opus", dest))
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=store, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [True] * 8)
+        folder = os.path.dirname(self.cache.get_path(self.key, "opus"))
+        self.assertEqual(os.listdir(folder),
+                         [os.path.basename(self.cache.get_path(self.key,
+                                                               "opus"))])
+
+    def test_key_lock_is_shared(self):
+        other = TranscodeCache.get_key("blake2:4567", "opus", "128k")
+        self.assertIs(self.cache.get_key_lock(self.key),
+                      self.cache.get_key_lock(self.key))
+        self.assertIsNot(self.cache.get_key_lock(self.key),
+                         self.cache.get_key_lock(other))
+
+    # An interrupted sync can leave the temp file of a fetch behind as a hard
+    # link to the cached file. Fetching into it again must not truncate the
+    # cached file, also if it has to be copied.
+    def test_fetch_into_leftover_hard_link(self):
+        temp_name = self.cache.get_temp_name(self.key, "opus")
+        with open(temp_name, "wb") as file:
+            file.write(b"encoded")
+        self.cache.store(self.key, "opus", temp_name)
+        path = self.cache.get_path(self.key, "opus")
+        dest = os.path.join(self.dir.name, ".mpd-ps-part.a.opus")
+        copy = DestinationWriter(self.dir.name).copy
+        for cross_device in (False, True):
+            os.link(path, dest)
+            if cross_device:
+                with mock.patch("os.link", side_effect=OSError(
+                        errno.EXDEV, "Invalid cross-device link")):
+                    found = self.cache.fetch(self.key, "opus", dest,
+                                             copy=copy)
+            else:
+                found = self.cache.fetch(self.key, "opus", dest, copy=copy)
+            self.assertTrue(found)
+            for name in (path, dest):
+                with open(name, "rb") as file:
+                    self.assertEqual(file.read(), b"encoded")
+            os.remove(dest)
+
+
+if __name__ == "__main__":
+    unittest.main()